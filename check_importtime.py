@@ -0,0 +1,71 @@
+#!/bin/python3
+"""
+Cold start budget check for the reconciliation CLI. Imports a module under `python -X importtime`
+and fails if its cumulative import time goes over budget or if it pulls in one of the heavy
+modules that only the downloader or the table rendering need
+"""
+import sys
+import os
+import argparse
+import subprocess
+
+DEFAULT_MODULE = "polizadiff"
+# Microseconds, best of --runs
+DEFAULT_BUDGET_US = 50_000
+FORBIDDEN_MODULES = ["requests", "asyncio", "tabulate", "poliza_api", "urllib3"]
+
+
+def measure_import(module: str) -> tuple[int, set[str]]:
+    """Returns the cumulative import time of module in microseconds and every module it imported"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=repo_dir, capture_output=True, text=True, check=True)
+    cumulative_us = None
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self_us, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            # Header line
+            continue
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            cumulative_us = int(cumulative)
+    return cumulative_us, imported
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--module", default=DEFAULT_MODULE)
+    argparser.add_argument("--budget-us", type=int, default=DEFAULT_BUDGET_US,
+                           help="Maximum cumulative import time in microseconds")
+    argparser.add_argument("--runs", type=int, default=5)
+    args = argparser.parse_args(argv[1:])
+
+    best_us = None
+    imported = set()
+    for _ in range(args.runs):
+        cumulative_us, imported = measure_import(args.module)
+        if cumulative_us is not None and (best_us is None or cumulative_us < best_us):
+            best_us = cumulative_us
+
+    failed = False
+    forbidden = sorted({module.split(".")[0] for module in imported} & set(FORBIDDEN_MODULES))
+    if forbidden:
+        print(f"FAIL: importing {args.module} loads {', '.join(forbidden)}")
+        failed = True
+    if best_us is None:
+        print(f"FAIL: {args.module} was not found in the importtime output")
+        failed = True
+    elif best_us > args.budget_us:
+        print(f"FAIL: {args.module} imports in {best_us}us, budget is {args.budget_us}us")
+        failed = True
+    else:
+        print(f"OK: {args.module} imports in {best_us}us (budget {args.budget_us}us)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
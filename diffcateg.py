@@ -4,10 +4,19 @@ import json
 import sys
 from unidecode import unidecode
 import csv
+import os
 import datetime as dt
 
 DIFF_CATEG_OUT_FILE_NAME = "pos_categ_diff_%d%m%Y%H%M.csv"
+DIFF_CATEG_DELTA_OUT_FILE_NAME = "pos_categ_diff_delta_%d%m%Y%H%M.csv"
 PRODUCT_CATALOG_OUT_FILE_NAME = "product_catalog_%d%m%Y%H%M.csv"
+# Previous run's report rows and the write_date watermark incremental runs start from
+DIFF_CATEG_STATE_FILE_NAME = "diffcateg_state.json"
+# Same format as odoo's write_date, which is stored in UTC
+WRITE_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+DIFF_CATEG_HEADERS = ["product_template_id", "Odoo Name", "pos_villa_identifier", "POS Villa Name", "Parent Category", "Categ Odoo (pos_categ_id)", "active", "Familia POS Villa", "Status"]
+PRODUCT_CATALOG_HEADERS = ["id", "pos_villa_id" ,"Name", "Parent Category", "Category", "Active"]
 
 PosVillaProduct = namedtuple("PosVillaProduct", ["pos_villa_identifier", "name", "family"])
 OdooProduct = namedtuple("OdooProduct", ["product_template_id","name", "pos_categ_id", "parent_category", "active"])
@@ -22,27 +31,34 @@ def record_to_pos_villa_product(record) -> PosVillaProduct:
 
 def get_market_products_rel(env) -> list:
     """Return a list matching each legacy product with its target equivalent in odoo"""
+    return list(get_market_products_rel_by_id(env).values())
 
+def get_market_products_rel_by_id(env, domain=None) -> dict:
+    """Legacy market product id -> VillaOdooRelation, for the legacy products that also match domain"""
     legacy_product = env["pos.villa.product"]
-    legacy_market_products = legacy_product.search([("consumption_center_id", "=", MARKET_CONSUMPTION_CENTER_ID)])
-    relations = []
+    legacy_market_products = legacy_product.search([("consumption_center_id", "=", MARKET_CONSUMPTION_CENTER_ID)] + (domain or []))
+    relations = {}
     for legacy_product in legacy_market_products:
         pos_villa_product = record_to_pos_villa_product(legacy_product)
         odoo_product = legacy_product.product_tmpl_id
         odoo_product = OdooProduct(odoo_product.id, odoo_product.name, odoo_product.pos_categ_id.name, odoo_product.pos_categ_id.parent_id.name, odoo_product.active)
-        relations.append(VillaOdooRelation(pos_villa_product, odoo_product))
+        relations[legacy_product.id] = VillaOdooRelation(pos_villa_product, odoo_product)
     return relations
 
 def get_all_odoo_products_relation(env) -> list:
+    return [relation for relations in get_odoo_products_relation_by_id(env).values() for relation in relations]
+
+def get_odoo_products_relation_by_id(env, domain=None) -> dict:
+    """Product id -> its OdooVillaRelations, for the products that match domain"""
     product = env["product.product"]
-    odoo_pos_villa_relations = []
-    for product in product.search([]):
+    odoo_pos_villa_relations = {}
+    for product in product.search(domain or []):
         odoo_product = OdooProduct(product.id, product.name, product.pos_categ_id.name, product.pos_categ_id.parent_id.name, product.active)
         if product.pos_villa_product_ids:
-            for legacy_product in product.pos_villa_product_ids:
-                odoo_pos_villa_relations.append(OdooVillaRelation(odoo_product, record_to_pos_villa_product(legacy_product)))
+            odoo_pos_villa_relations[product.id] = [OdooVillaRelation(odoo_product, record_to_pos_villa_product(legacy_product))
+                                                    for legacy_product in product.pos_villa_product_ids]
         else:
-            odoo_pos_villa_relations.append(OdooVillaRelation(odoo_product, None))
+            odoo_pos_villa_relations[product.id] = [OdooVillaRelation(odoo_product, None)]
     return odoo_pos_villa_relations
 
 def product_categories_match(pos_villa_product: PosVillaProduct, odoo_product: OdooProduct) -> bool:
@@ -50,35 +66,123 @@ def product_categories_match(pos_villa_product: PosVillaProduct, odoo_product: O
     odoo_categ = odoo_product.pos_categ_id and unidecode(odoo_product.pos_categ_id.lower())
     return (villa_categ and odoo_categ and (villa_categ in odoo_categ or odoo_categ in villa_categ))
 
-def main(env):
-    now = dt.datetime.now()
-    diff_filename = now.strftime(DIFF_CATEG_OUT_FILE_NAME)
-    with open(diff_filename, "w") as outfile:
-        writer = csv.writer(outfile, quoting=csv.QUOTE_ALL)
-        HEADERS = ["product_template_id", "Odoo Name", "pos_villa_identifier", "POS Villa Name", "Parent Category", "Categ Odoo (pos_categ_id)", "active", "Familia POS Villa", "Status"]
-        writer.writerow(HEADERS)
-        products_rel = get_market_products_rel(env)
-        for pos_villa_product, odoo_product in products_rel:
-            if not product_categories_match(pos_villa_product, odoo_product):
-                product_template_id = odoo_product.product_template_id or "SIN EQUIVALENTE EN ODOO"
-                odoo_name = odoo_product.name or "SIN EQUIVALENTE EN ODOO"
-                pos_villa_id = pos_villa_product.pos_villa_identifier or "SIN EQUIVALENTE EN POS VILLA"
-                pos_villa_name = pos_villa_product.name or "SIN EQUIVALENTE EN POS VILLA"
-                parent_category = odoo_product.parent_category or "SIN CATEGORIA"
-                categ_odoo = odoo_product.pos_categ_id or "SIN CATEGORIA EN ODOO"
-                active = odoo_product.active
-                familia_pos_villa = pos_villa_product.family or "SIN CATEGORIA"
-                status = "TODO"
-                if odoo_product.name:
-                    writer.writerow([product_template_id, odoo_name, pos_villa_id, pos_villa_name, parent_category, categ_odoo, active, familia_pos_villa, status])
-
-    catalog_filename = now.strftime(PRODUCT_CATALOG_OUT_FILE_NAME)
-    with open(catalog_filename, "w") as outfile:
+def get_diff_categ_row(pos_villa_product: PosVillaProduct, odoo_product: OdooProduct) -> list:
+    """Row of the categories diff report, None if the categories match or there's no odoo product"""
+    if product_categories_match(pos_villa_product, odoo_product) or not odoo_product.name:
+        return None
+    product_template_id = odoo_product.product_template_id or "SIN EQUIVALENTE EN ODOO"
+    odoo_name = odoo_product.name or "SIN EQUIVALENTE EN ODOO"
+    pos_villa_id = pos_villa_product.pos_villa_identifier or "SIN EQUIVALENTE EN POS VILLA"
+    pos_villa_name = pos_villa_product.name or "SIN EQUIVALENTE EN POS VILLA"
+    parent_category = odoo_product.parent_category or "SIN CATEGORIA"
+    categ_odoo = odoo_product.pos_categ_id or "SIN CATEGORIA EN ODOO"
+    active = odoo_product.active
+    familia_pos_villa = pos_villa_product.family or "SIN CATEGORIA"
+    status = "TODO"
+    return [product_template_id, odoo_name, pos_villa_id, pos_villa_name, parent_category, categ_odoo, active, familia_pos_villa, status]
+
+def get_catalog_rows(relations: list) -> list:
+    rows = []
+    for odoo_product, pos_villa_product in relations:
+        id, name, categ, parent_categ, active = odoo_product
+        pos_villa_id = pos_villa_product.pos_villa_identifier if pos_villa_product else "N/A"
+        rows.append([id, pos_villa_id, name, parent_categ or "SIN CATEGORIA" , categ or "SIN CATEGORIA", active])
+    return rows
+
+def load_state(state_file_name: str) -> dict:
+    if not os.path.exists(state_file_name):
+        return None
+    with open(state_file_name, "r") as state_file:
+        return json.load(state_file)
+
+def save_state(state_file_name: str, state: dict):
+    tmp_file_name = state_file_name + ".tmp"
+    with open(tmp_file_name, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_file_name, state_file_name)
+
+def get_changed_domains(env, watermark: str, previous_links: dict = None, previous_catalog_rows: dict = None) -> tuple:
+    """Domains over pos.villa.product and product.product for the records whose report rows may have
+    changed since watermark: the record itself, its product template, its legacy products or its
+    category (or a parent category, which is part of the row) were modified. A relink only touches the
+    legacy product and its new target, so the previous run's link targets are also included: legacy
+    products whose previous template changed, and products whose catalog rows listed a changed legacy product"""
+    changed_categs = env["pos.category"].search([("write_date", ">=", watermark)])
+    categ_ids = env["pos.category"].search([("id", "child_of", changed_categs.ids)]).ids if changed_categs else []
+    changed_templates = env["product.template"].search([("write_date", ">=", watermark)])
+    changed_template_ids = set(changed_templates.ids)
+    relinked_ids = [int(legacy_id) for legacy_id, template_id in (previous_links or {}).items()
+                    if template_id in changed_template_ids]
+    legacy_domain = ["|", "|", "|", ("write_date", ">=", watermark), ("product_tmpl_id", "in", changed_templates.ids),
+                     ("product_tmpl_id.pos_categ_id", "in", categ_ids), ("id", "in", relinked_ids)]
+    changed_identifiers = set(env["pos.villa.product"].search([("write_date", ">=", watermark)]).mapped("pos_villa_identifier"))
+    previous_product_ids = [int(product_id) for product_id, rows in (previous_catalog_rows or {}).items()
+                            if any(row[1] in changed_identifiers for row in rows)]
+    product_domain = ["|", "|", "|", "|", ("write_date", ">=", watermark), ("product_tmpl_id.write_date", ">=", watermark),
+                      ("pos_categ_id", "in", categ_ids), ("pos_villa_product_ids.write_date", ">=", watermark),
+                      ("id", "in", previous_product_ids)]
+    return legacy_domain, product_domain
+
+def write_csv(file_name: str, headers: list, rows):
+    with open(file_name, "w") as outfile:
         writer = csv.writer(outfile, quoting=csv.QUOTE_ALL)
-        HEADERS = ["id", "pos_villa_id" ,"Name", "Parent Category", "Category", "Active"]
-        writer.writerow(HEADERS)
-        all_odoo_product_relations = get_all_odoo_products_relation(env)
-        for odoo_product, pos_villa_product in all_odoo_product_relations:
-            id, name, categ, parent_categ, active = odoo_product
-            pos_villa_id = pos_villa_product.pos_villa_identifier if pos_villa_product else "N/A"
-            writer.writerow([id, pos_villa_id, name, parent_categ or "SIN CATEGORIA" , categ or "SIN CATEGORIA", active])
+        writer.writerow(headers)
+        writer.writerows(rows)
+
+def main(env, incremental=False, state_file_name=DIFF_CATEG_STATE_FILE_NAME):
+    """With incremental, only the records modified since the previous run's write_date watermark are
+    re-read; the rest of the report rows come from the state file. Besides the full reports, an
+    incremental run writes a delta report with the diff rows that appeared, changed or went away"""
+    now = dt.datetime.now()
+    # Taken before reading anything, so records written during this run are read again on the next one
+    watermark = dt.datetime.now(dt.timezone.utc).strftime(WRITE_DATE_FORMAT)
+    state = load_state(state_file_name) if incremental else None
+
+    if state:
+        # States written before links were saved only miss the relinks of their first incremental run
+        legacy_domain, product_domain = get_changed_domains(env, state["watermark"], state.get("links"),
+                                                            state["catalog_rows"])
+        previous_diff_rows = state["diff_rows"]
+        diff_rows = dict(previous_diff_rows)
+        links = dict(state.get("links", {}))
+        catalog_rows = dict(state["catalog_rows"])
+        # Only ids are read for the whole catalog, to drop records that were deleted or moved out and keep the report order
+        market_ids = env["pos.villa.product"].search([("consumption_center_id", "=", MARKET_CONSUMPTION_CENTER_ID)]).ids
+        product_ids = env["product.product"].search([]).ids
+    else:
+        legacy_domain, product_domain = None, None
+        previous_diff_rows = {}
+        diff_rows, catalog_rows = {}, {}
+        links = {}
+        market_ids, product_ids = None, None
+
+    relinked_template_ids = []
+    for legacy_id, (pos_villa_product, odoo_product) in get_market_products_rel_by_id(env, legacy_domain).items():
+        diff_rows[str(legacy_id)] = get_diff_categ_row(pos_villa_product, odoo_product)
+        if state and links.get(str(legacy_id)) != odoo_product.product_template_id:
+            # The new target's catalog rows now list this legacy product too
+            relinked_template_ids.append(odoo_product.product_template_id)
+        links[str(legacy_id)] = odoo_product.product_template_id
+    if relinked_template_ids:
+        product_domain = ["|", ("product_tmpl_id", "in", relinked_template_ids)] + product_domain
+    for product_id, relations in get_odoo_products_relation_by_id(env, product_domain).items():
+        catalog_rows[str(product_id)] = get_catalog_rows(relations)
+    if market_ids is not None:
+        diff_rows = {str(legacy_id): diff_rows.get(str(legacy_id)) for legacy_id in market_ids}
+        links = {legacy_id: links[legacy_id] for legacy_id in diff_rows if legacy_id in links}
+        catalog_rows = {str(product_id): catalog_rows.get(str(product_id), []) for product_id in product_ids}
+
+    write_csv(now.strftime(DIFF_CATEG_OUT_FILE_NAME), DIFF_CATEG_HEADERS, filter(None, diff_rows.values()))
+    write_csv(now.strftime(PRODUCT_CATALOG_OUT_FILE_NAME), PRODUCT_CATALOG_HEADERS,
+              (row for rows in catalog_rows.values() for row in rows))
+    if state:
+        delta_rows = []
+        for legacy_id in list(diff_rows) + [legacy_id for legacy_id in previous_diff_rows if legacy_id not in diff_rows]:
+            row, previous_row = diff_rows.get(legacy_id), previous_diff_rows.get(legacy_id)
+            if row == previous_row:
+                continue
+            change = "NUEVO" if not previous_row else "RESUELTO" if not row else "CAMBIO"
+            delta_rows.append([change] + (row or previous_row))
+        write_csv(now.strftime(DIFF_CATEG_DELTA_OUT_FILE_NAME), ["Cambio"] + DIFF_CATEG_HEADERS, delta_rows)
+    save_state(state_file_name, {"watermark": watermark, "diff_rows": diff_rows, "catalog_rows": catalog_rows,
+                                 "links": links})
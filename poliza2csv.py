@@ -1,5 +1,7 @@
 #!/bin/python3
 import sys
+import os
+import mmap
 from collections import namedtuple
 import re
 
@@ -7,6 +9,16 @@ PolizaLine = namedtuple(
     "PolizaLine", ["account", "concept", "sign", "amount", "type"])
 
 SKIP_FIRST = 2
+ACCOUNT_LEN = 11
+CONCEPT_LEN = 50
+AMOUNT_MATCHER = re.compile(r"((?P<sign>-)*(?P<amount>\d+\.\d+))(?P<type>a|c)")
+AMOUNT_BYTES_MATCHER = re.compile(rb"(-*)(\d+\.\d+)([ac])")
+# One TXT record: account, concept and the rest of the line. Like process_line over a text mode line,
+# the line terminator counts towards the minimum length, so a 60 byte line still has a 49 byte concept.
+# The usual right aligned amount is captured right away, anything else is left to AMOUNT_BYTES_MATCHER
+TXT_RECORD_MATCHER = re.compile(
+    rb"^(.{%d})(.{%d}|[^\r\n]{%d}(?=\r?\n))(?: *(-*)(\d+\.\d+)([ac]))?(.*)"
+    % (ACCOUNT_LEN, CONCEPT_LEN, CONCEPT_LEN - 1), re.MULTILINE)
 EXCLUDED_CONCEPTS = [
     'PAQ MLP MENOR NET CENTER 54 US',
     'PAQ MLP PREARRIVAL 97.20 USD A',
@@ -81,8 +93,6 @@ def valid_args(argv) -> bool:
 
 
 def process_line(line: str) -> PolizaLine:
-    ACCOUNT_LEN = 11
-    CONCEPT_LEN = 50
     if len(line) < ACCOUNT_LEN + CONCEPT_LEN:
         return None
     account = line[0:ACCOUNT_LEN].strip()
@@ -93,15 +103,46 @@ def process_line(line: str) -> PolizaLine:
 
 
 def process_amount(amount: str) -> tuple:
-    amount_matcher = re.compile(
-        r"((?P<sign>-)*(?P<amount>\d+\.\d+))(?P<type>a|c)")
-    amount_match = amount_matcher.search(amount)
+    amount_match = AMOUNT_MATCHER.search(amount)
     sign = (amount_match["sign"] if amount_match else "-") or "+"
     amount = amount_match["amount"] if amount_match else "0.0"
     _type = amount_match["type"] if amount_match else "c"
     return (sign, amount, _type)
 
 
+def iter_txt_poliza_lines(fname: str, line_filter=None, skip_first=SKIP_FIRST):
+    """Same lines as process_line over every line of a TXT poliza, but the file is memory-mapped and its
+    records and amounts are matched on the raw bytes: only the account and concept slices are decoded.
+    line_filter(concept) is checked before a PolizaLine is built"""
+    with open(fname, "rb") as txt_file:
+        if os.fstat(txt_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(txt_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = 0
+            for _ in range(skip_first):
+                start = data.find(b"\n", start) + 1
+                if not start:
+                    return
+            # Accounts and concepts repeat all over an export, each distinct slice is decoded once
+            decoded = {}
+            for record in TXT_RECORD_MATCHER.finditer(data, start):
+                account, concept, sign, amount, _type, rest = record.groups()
+                if (concept_str := decoded.get(concept)) is None:
+                    concept_str = decoded[concept] = concept.decode("ISO-8859-1").strip()
+                if line_filter is not None and not line_filter(concept_str):
+                    continue
+                if (account_str := decoded.get(account)) is None:
+                    account_str = decoded[account] = account.decode("ISO-8859-1").strip()
+                if amount is None:
+                    amount_match = AMOUNT_BYTES_MATCHER.search(rest)
+                    if not amount_match:
+                        yield PolizaLine(account_str, concept_str, "-", "0.0", "c")
+                        continue
+                    sign, amount, _type = amount_match.groups()
+                yield PolizaLine(account_str, concept_str, "-" if sign else "+", amount.decode("ascii"),
+                                 "a" if _type == b"a" else "c")
+
+
 def format_amount(amount: tuple) -> str:
     sign, amount, _type = amount
     return (sign if sign == "-" else "") + str(amount) + _type
@@ -111,17 +152,11 @@ def main(argv):
     if not valid_args(argv):
         print("Invalid args")
     fname = argv[1]
-    with open(fname, "r", encoding="ISO-8859-1") as input_file:
-        print("'Cuenta','Concepto','Monto'")
-        for _ in range(SKIP_FIRST):
-            next(input_file)
-        for line in input_file:
-            line_vals = process_line(line)
-            if line_vals:
-                account, concept, sign, amount, amount_type = line_vals
-                if not any(concept in excluded_concept for excluded_concept in EXCLUDED_CONCEPTS):
-                    print(
-                        f"'{account}','{concept}','{(sign if sign == '-' else '') + amount + amount_type}'")
+    print("'Cuenta','Concepto','Monto'")
+    for account, concept, sign, amount, amount_type in iter_txt_poliza_lines(fname):
+        if not any(concept in excluded_concept for excluded_concept in EXCLUDED_CONCEPTS):
+            print(
+                f"'{account}','{concept}','{(sign if sign == '-' else '') + amount + amount_type}'")
 
 
 if __name__ == "__main__":
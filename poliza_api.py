@@ -1,12 +1,19 @@
 #!/bin/python3
 import json
-from dataclasses import dataclass
-from poliza2csv import EXCLUDED_CONCEPTS
+from poliza_payload import (PolizaAPILine, read_json_lines, write_payload, verify_payload, PAYLOAD_SUFFIX,
+                           CHECKSUM_SUFFIX)
 from enum import Enum
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from poliza_http import PolizaHTTPClient, CircuitOpenError
+from poliza_metrics import PipelineMetrics
 import requests
 import asyncio
+import argparse
+import sys
 import os
+import re
 
 VG_POLIZA_URL_BASE = "https://restful.frontoffice.villagroup.com/PMSBusinessServer/BusinessServersISAPI.dll/datasnap/rest/todoo/"
 
@@ -14,18 +21,25 @@ MAX_ACTIVE_REQUESTS = 1
 
 POLIZA_OUTPUT_DIR = "/home/carlos-vx/Vauxoo/poliza/polizas_api/"
 
+MAX_DOWNLOAD_ATTEMPTS = 5
+
+# Plain payloads from older runs and the compressed ones write_payload produces
+PAYLOAD_FNAME_MATCHER = re.compile(r"^POLIZAINGRESOS_(?P<date>\d{8})\.json(\.gz)?$")
+INVALID_SUFFIX = ".invalid"
+
+# Reports of --reconcile-vx-dir with --backfill, which only cover the days just downloaded
+BACKFILL_REPORT_FNAME = "REPORTE_MATCHES_POLIZA_BACKFILL.csv"
+BACKFILL_DIFF_REPORT_FNAME = "REPORTE_DIFFS_POLIZA_BACKFILL.csv"
+
 active_requests = []
 pending_downloads = set()
 initial_requests = []
 global_exit_flag = []
+download_attempts = defaultdict(int)
+failed_downloads = []
+metrics = PipelineMetrics()
 
-
-@dataclass
-class PolizaAPILine:
-    cuenta: str
-    concepto: str
-    cargo: float
-    abono: float
+_http_client = None
 
 
 class PolizaRequestStatus(Enum):
@@ -53,6 +67,13 @@ class PolizaAPIRequest:
         return f"APIRequest(id={self.id}, start_date={self.start_date.strftime('%d-%m-%Y')}, end_date={self.end_date.strftime('%d-%m-%Y')})"
 
 
+def get_http_client() -> PolizaHTTPClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = PolizaHTTPClient(VG_POLIZA_URL_BASE)
+    return _http_client
+
+
 def _post_poliza_init(req: PolizaAPIRequest) -> PolizaAPIRequest:
     dt_format = "%d-%m-%Y"
     params = {
@@ -61,8 +82,13 @@ def _post_poliza_init(req: PolizaAPIRequest) -> PolizaAPIRequest:
         "FechaFin": req.end_date.strftime(dt_format)
     }
     headers = {'Content-Type': 'application/json'}
-    response = requests.post(
-        VG_POLIZA_URL_BASE + "ProcesaPoliza", data=json.dumps(params), headers=headers)
+    try:
+        response = get_http_client().post(
+            "ProcesaPoliza", data=json.dumps(params), headers=headers)
+    except requests.RequestException as e:
+        print(f"ProcesaPoliza failed for {req}: {e}")
+        req.status = PolizaRequestStatus.ERROR
+        return req
     if response.status_code == 200:
         req.status = PolizaRequestStatus.ACTIVE
         resp_data = response.json()
@@ -74,8 +100,13 @@ def _post_poliza_init(req: PolizaAPIRequest) -> PolizaAPIRequest:
 
 
 def _get_request_status(req: PolizaAPIRequest) -> PolizaRequestStatus:
-    response = requests.get(VG_POLIZA_URL_BASE +
-                            f"EstadoProceso/{req.resort_id}/{req.id}")
+    """Returns the request's current status as reported by VG. If VG can't be reached
+    or answers with something unexpected, the last known status is kept"""
+    try:
+        response = get_http_client().get("EstadoProceso", f"{req.resort_id}/{req.id}")
+    except requests.RequestException as e:
+        print(f"EstadoProceso failed for {req}: {e}")
+        return req.status
     if response:
         data = response.json()
         status = data["Estatus"]
@@ -83,11 +114,20 @@ def _get_request_status(req: PolizaAPIRequest) -> PolizaRequestStatus:
             return PolizaRequestStatus.COMPLETED
         elif status == "Activo":
             return PolizaRequestStatus.ACTIVE
+        print(f"Unexpected status {status} for {req}")
+    return req.status
 
 
 def _get_poliza(date, resort_id=16) -> dict:
-    response = requests.get(VG_POLIZA_URL_BASE +
-                            f"Poliza/{resort_id}/{date.strftime('%d-%m-%Y')}")
+    """None if the download failed. Raises CircuitOpenError while the Poliza circuit is open, as
+    that isn't a download attempt"""
+    try:
+        response = get_http_client().get("Poliza", f"{resort_id}/{date.strftime('%d-%m-%Y')}")
+    except CircuitOpenError:
+        raise
+    except requests.RequestException as e:
+        print(f"Poliza failed for {date}: {e}")
+        return None
     if response:
         data = response.json()
         return data
@@ -120,14 +160,53 @@ def get_requests_in_range(start_date, end_date, dates_per_req=1):
     return requests
 
 
-def read_json_lines(json):
-    lines = []
-    for line in json["Poliza"]:
-        api_line = PolizaAPILine(
-            cuenta=line["Cuenta"], concepto=line["Concepto"], cargo=float(line["Cargo"]), abono=float(line["Abono"]))
-        if api_line.concepto not in EXCLUDED_CONCEPTS:
-            lines.append(api_line)
-    return lines
+def quarantine_payload(fname: str) -> str:
+    """Move an invalid payload and its checksum sidecar out of the way, as hidden files that neither
+    backfill nor polizadiff pick up. Returns the payload's new name"""
+    dirname, basename = os.path.split(fname)
+    invalid_fname = os.path.join(dirname, "." + basename + INVALID_SUFFIX)
+    os.replace(fname, invalid_fname)
+    if os.path.exists(fname + CHECKSUM_SUFFIX):
+        os.replace(fname + CHECKSUM_SUFFIX, invalid_fname + CHECKSUM_SUFFIX)
+    return invalid_fname
+
+
+def get_downloaded_dates(output_dir: str, verify=False) -> set[datetime]:
+    """Days that already have a payload in output_dir. With verify, payloads that fail verify_payload
+    are quarantined, and their days are left out unless another payload of the same day is valid"""
+    dates = set()
+    if not os.path.isdir(output_dir):
+        return dates
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            fname_match = PAYLOAD_FNAME_MATCHER.match(entry.name)
+            if not fname_match or not entry.is_file():
+                continue
+            if verify and not verify_payload(entry.path):
+                invalid_fname = quarantine_payload(entry.path)
+                print(f"INVALID: {entry.path}, moved to {invalid_fname}")
+                continue
+            dates.add(datetime.strptime(fname_match["date"], "%Y%m%d"))
+    return dates
+
+
+def get_missing_date_ranges(start_date, end_date, downloaded_dates: set) -> list[tuple]:
+    """Days between start_date and end_date (both inclusive) without a payload, merged into
+    the fewest (first, last) ranges of consecutive days"""
+    ranges = []
+    for date in daterange(start_date, end_date):
+        if date in downloaded_dates:
+            continue
+        if ranges and ranges[-1][1] + timedelta(days=1) == date:
+            ranges[-1] = (ranges[-1][0], date)
+        else:
+            ranges.append((date, date))
+    return ranges
+
+
+def get_backfill_requests(missing_ranges: list[tuple]) -> list[PolizaAPIRequest]:
+    # The API is not inclusive on end date, the transfer step downloads start_date..end_date - 1
+    return [PolizaAPIRequest(first, last + timedelta(days=1)) for first, last in missing_ranges]
 
 
 async def push_pending_requests(initial_requests_lock, active_requests_lock, interval=60):
@@ -137,15 +216,18 @@ async def push_pending_requests(initial_requests_lock, active_requests_lock, int
                 next_req = initial_requests.pop()
                 if len(active_requests) >= MAX_ACTIVE_REQUESTS:
                     print("Active queue is full. Going to sleep")
+                    metrics.count("queue_full")
                     initial_requests.append(next_req)
                 else:
                     print(f"Posting request for {next_req}")
                     active_req = _post_poliza_init(next_req)
+                    metrics.set_status(active_req, active_req.status)
                     print(active_req)
                     if active_req.status != PolizaRequestStatus.ACTIVE:
                         # Something went wrong
                         print(
                             f"Something went wrong for request {active_req}")
+                        metrics.count("post_errors")
                         initial_requests.append(active_req)
                     else:
                         active_requests.append(active_req)
@@ -172,6 +254,7 @@ async def update_requests_status(active_requests_lock, exit_flag_lock, interval=
                     print(
                         f"Status for request {req} changed from {req.status} to {status}")
                 req.status = status
+                metrics.set_status(req, status)
         async with exit_flag_lock:
             if global_exit_flag:
                 return
@@ -190,6 +273,7 @@ async def transfer_requests_to_pending_download_queue(active_requests_lock, pend
                     # should account for those days when downloading, and the next request will process 05/12
                     for dt in daterange(possibly_done.start_date, possibly_done.end_date - timedelta(days=1)):
                         pending_downloads.add(dt)
+                    metrics.finish_request(possibly_done)
                 elif possibly_done.status == PolizaRequestStatus.ACTIVE:
                     active_requests.append(possibly_done)
                 else:
@@ -204,19 +288,92 @@ async def transfer_requests_to_pending_download_queue(active_requests_lock, pend
                 return
 
 
-async def get_payloads(pending_downloads_lock, exit_flag_lock, interval=30):
+class PayloadReconciler:
+    """Reconciles each downloaded payload against its VX poliza on a worker thread, reusing the
+    in-memory payload, while the remaining downloads go on"""
+
+    def __init__(self, poliza_vx_dir: str, collapse_accounts=False, collapse_file=".collapse", sister_file=None,
+                 report_fname=None, diff_report_fname=None):
+        # polizadiff is only needed when reconciling, keep the plain download path light
+        import polizadiff
+        self.polizadiff = polizadiff
+        self.report_fname = report_fname or polizadiff.REPORT_FNAME
+        self.diff_report_fname = diff_report_fname or polizadiff.DIFF_REPORT_FNAME
+        self.poliza_vx_dir = poliza_vx_dir
+        self.options = polizadiff.ReconcileOptions(collapse_accounts=collapse_accounts, collapse_file=collapse_file,
+                                                   sister_file=sister_file)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def submit(self, date: datetime, data: dict, vg_fname: str):
+        self.futures.append(self.executor.submit(self._reconcile, date, data, vg_fname))
+
+    def _reconcile(self, date: datetime, data: dict, vg_fname: str):
+        """None if the day can't be reconciled, so one bad file doesn't lose the reports of every other day"""
+        poliza_date_stamp = date.strftime("%Y%m%d")
+        vx_fname = self.polizadiff.get_vx_poliza_fname(self.poliza_vx_dir, poliza_date_stamp)
+        if not os.path.exists(vx_fname):
+            print(f"SKIP: {vx_fname} not found")
+            return None
+        try:
+            lines_vg = self.polizadiff.json_to_poliza_lines(data)
+            lines_vx = self.polizadiff.get_vx_poliza_lines(vx_fname)
+            day_result = self.polizadiff.diff_poliza_day(poliza_date_stamp, lines_vg, lines_vx, self.options)
+        except Exception as e:
+            print(f"SKIP: {poliza_date_stamp}: {type(e).__name__}: {e}")
+            return None
+        if day_result.match_pctg < 1:
+            print(self.polizadiff.format_day_result(day_result, vg_fname, vx_fname))
+        return day_result
+
+    def finish(self):
+        """Wait for pending reconciliations and write the same reports as a DIR_DIFF run"""
+        self.executor.shutdown(wait=True)
+        day_results = [future.result() for future in self.futures]
+        day_results = sorted(filter(None, day_results), key=lambda day_result: day_result.date_stamp)
+        if not day_results:
+            print("No payloads were reconciled")
+            return
+        self.polizadiff.print_global_stats(day_results)
+        self.polizadiff.print_sister_swaps(day_results)
+        self.polizadiff.write_dir_reports(day_results, self.report_fname, self.diff_report_fname)
+        print(f"Reports for the {len(day_results)} reconciled days written to {self.report_fname} and {self.diff_report_fname}")
+
+
+async def get_payloads(pending_downloads_lock, exit_flag_lock, interval=30, reconciler: PayloadReconciler = None):
     while True:
         await asyncio.sleep(interval)
         async with pending_downloads_lock:
             try:
                 date_to_download = pending_downloads.pop()
                 print(f"Getting payload for {date_to_download}")
-                data = _get_poliza(date_to_download)
-                if data:
+                try:
+                    data, circuit_open = _get_poliza(date_to_download), False
+                except CircuitOpenError:
+                    data, circuit_open = None, True
+                if circuit_open:
+                    # Not an attempt: the day waits for the circuit to half-open without using up its attempts
+                    print(f"Poliza circuit open, {date_to_download} waits for it to close")
+                    pending_downloads.add(date_to_download)
+                    metrics.count("download_circuit_waits")
+                elif not data:
+                    # Put it back so a transient error doesn't lose the day
+                    download_attempts[date_to_download] += 1
+                    if download_attempts[date_to_download] < MAX_DOWNLOAD_ATTEMPTS:
+                        pending_downloads.add(date_to_download)
+                        metrics.count("download_retries")
+                    else:
+                        print(f"Giving up on payload for {date_to_download}")
+                        failed_downloads.append(date_to_download)
+                        metrics.count("download_failures")
+                else:
                     fname = date_to_download.strftime(
-                        "POLIZAINGRESOS_%Y%m%d.json")
-                    with open(os.path.join(POLIZA_OUTPUT_DIR, fname), "w") as file:
-                        json.dump(data, file)
+                        "POLIZAINGRESOS_%Y%m%d") + PAYLOAD_SUFFIX
+                    fname = os.path.join(POLIZA_OUTPUT_DIR, fname)
+                    write_payload(fname, data)
+                    metrics.count("downloads")
+                    if reconciler:
+                        reconciler.submit(date_to_download, data, fname)
             except KeyError:
                 # Empty completed queue
                 print("No pending payloads to process")
@@ -237,15 +394,75 @@ async def supervisor(initial_requests_lock, active_requests_lock, pending_downlo
         await asyncio.sleep(interval)
 
 
-async def main():
-    d0 = datetime(2023, 1, 1)
+async def report_metrics(initial_requests_lock, active_requests_lock, pending_downloads_lock, exit_flag_lock,
+                         metrics_fname=None, interval=15):
+    while True:
+        async with initial_requests_lock, active_requests_lock, pending_downloads_lock:
+            metrics.sample_queues(len(initial_requests), len(active_requests), len(pending_downloads))
+        if metrics_fname:
+            metrics.write(metrics_fname, get_http_client())
+        async with exit_flag_lock:
+            if global_exit_flag:
+                return
+        await asyncio.sleep(interval)
+
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+async def main(argv):
+    global POLIZA_OUTPUT_DIR
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--from", dest="date_from", type=parse_date, default=datetime(2023, 1, 1),
+                           help="First day to download (YYYY-MM-DD)")
+    argparser.add_argument("--to", dest="date_to", type=parse_date, default=datetime(2023, 2, 12),
+                           help="Last day to download, inclusive (YYYY-MM-DD)")
+    argparser.add_argument("--output-dir", default=POLIZA_OUTPUT_DIR)
+    argparser.add_argument("--reconcile-vx-dir",
+                           help="Reconcile every payload against POLIZAINGRESOS_VX<date>.csv in this directory as it is downloaded")
+    argparser.add_argument("--collapse-accounts", action="store_true",
+                           help="Collapse accounts when reconciling, see polizadiff.py")
+    argparser.add_argument("--collapse-file", default=".collapse")
+    argparser.add_argument("--sister-file", help="Sister accounts file when reconciling, see polizadiff.py")
+    argparser.add_argument("--backfill", action="store_true",
+                           help="Only request the days in the range without a payload in --output-dir")
+    argparser.add_argument("--verify-existing", action="store_true",
+                           help="With --backfill, also download again the payloads that fail their checksum")
+    argparser.add_argument("--metrics-file",
+                           help="Periodically rewrite the pipeline metrics here, as JSON if it ends in .json "
+                                "and in Prometheus text format otherwise")
+    argparser.add_argument("--metrics-interval", type=int, default=15, help="Seconds between metrics samples")
+    args = argparser.parse_args(argv[1:])
+    POLIZA_OUTPUT_DIR = args.output_dir
+
+    d0 = args.date_from
     # The API is not inclusive on end date
-    df = datetime(2023, 2, 12) + timedelta(days=1)
+    df = args.date_to + timedelta(days=1)
+
+    reconciler = None
+    if args.reconcile_vx_dir:
+        # A backfill only reconciles the missing days, don't overwrite the reports of a full DIR_DIFF run with them
+        report_fnames = (BACKFILL_REPORT_FNAME, BACKFILL_DIFF_REPORT_FNAME) if args.backfill else (None, None)
+        reconciler = PayloadReconciler(args.reconcile_vx_dir, args.collapse_accounts, args.collapse_file,
+                                       args.sister_file, *report_fnames)
+
+    if args.backfill:
+        downloaded_dates = get_downloaded_dates(POLIZA_OUTPUT_DIR, args.verify_existing)
+        missing_ranges = get_missing_date_ranges(args.date_from, args.date_to, downloaded_dates)
+        missing_days = sum((last - first).days + 1 for first, last in missing_ranges)
+        print(f"Backfill: {missing_days} missing days in {len(missing_ranges)} ranges")
+        if not missing_ranges:
+            return
+        reqs = get_backfill_requests(missing_ranges)
+    else:
+        reqs = get_requests_in_range(d0, df, 1)
 
     print("Initial requests:")
-    for req in get_requests_in_range(d0, df, 1):
+    for req in reqs:
         print(req)
         initial_requests.append(req)
+        metrics.set_status(req, req.status)
     initial_requests.reverse()
     initial_requests_lock = asyncio.Lock()
     active_requests_lock = asyncio.Lock()
@@ -260,14 +477,27 @@ async def main():
             active_requests_lock,
             pending_downloads_lock,
             exit_flag_lock, 15),
-        get_payloads(pending_downloads_lock, exit_flag_lock, 10),
+        get_payloads(pending_downloads_lock, exit_flag_lock, 10, reconciler),
         supervisor(initial_requests_lock,
                    active_requests_lock,
                    pending_downloads_lock,
-                   exit_flag_lock, 5)
+                   exit_flag_lock, 5),
+        report_metrics(initial_requests_lock,
+                       active_requests_lock,
+                       pending_downloads_lock,
+                       exit_flag_lock,
+                       args.metrics_file, args.metrics_interval)
     )
+    if reconciler:
+        reconciler.finish()
+    print(get_http_client().format_stats())
+    print(metrics.format_summary(get_http_client()))
+    if args.metrics_file:
+        metrics.write(args.metrics_file, get_http_client())
+    if failed_downloads:
+        print("Could not download: " + ", ".join(date.strftime("%d-%m-%Y") for date in sorted(failed_downloads)))
     print("Finished!")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(sys.argv))
@@ -0,0 +1,122 @@
+"""
+Shared HTTP client for the VG poliza endpoints: one pooled session, gzip/deflate, bounded retries
+with backoff, per endpoint timeouts, a circuit breaker per endpoint and latency/error counters
+"""
+import time
+from collections import defaultdict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from poliza_metrics import Histogram
+
+# (connect, read) seconds
+ENDPOINT_TIMEOUTS = {
+    "ProcesaPoliza": (5, 30),
+    "EstadoProceso": (5, 15),
+    "Poliza": (5, 120),
+}
+DEFAULT_TIMEOUT = (5, 30)
+
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 1.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Consecutive failures that open an endpoint's circuit, and seconds before a call is let through again
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 120
+
+
+class CircuitOpenError(requests.RequestException):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        # Half open: let a call through once the reset timeout passed, a failure re-opens the circuit
+        return time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class PolizaHTTPClient:
+    def __init__(self, base_url: str, timeouts: dict = None, max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+        self.base_url = base_url
+        self.timeouts = timeouts or ENDPOINT_TIMEOUTS
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        # POST isn't idempotent (it queues a job on VG), so it is only retried on connection errors
+        retry = Retry(total=max_retries, connect=max_retries, read=max_retries, status=max_retries,
+                      backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset({"GET"}), raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.breakers = defaultdict(CircuitBreaker)
+        self.stats = defaultdict(lambda: defaultdict(float))
+        self.latency_histograms = defaultdict(Histogram)
+
+    def get(self, endpoint: str, path: str = "", **kwargs) -> requests.Response:
+        return self.request("GET", endpoint, path, **kwargs)
+
+    def post(self, endpoint: str, path: str = "", **kwargs) -> requests.Response:
+        return self.request("POST", endpoint, path, **kwargs)
+
+    def request(self, method: str, endpoint: str, path: str = "", **kwargs) -> requests.Response:
+        """Raises CircuitOpenError while the endpoint's circuit is open and requests.RequestException
+        on connection errors once retries are exhausted. HTTP error statuses are returned as is,
+        but count as failures for the circuit breaker"""
+        stats = self.stats[endpoint]
+        breaker = self.breakers[endpoint]
+        if not breaker.allow():
+            stats["rejected"] += 1
+            raise CircuitOpenError(f"Circuit open for {endpoint}")
+        url = self.base_url + endpoint + (f"/{path}" if path else "")
+        kwargs.setdefault("timeout", self.timeouts.get(endpoint, DEFAULT_TIMEOUT))
+        start = time.monotonic()
+        stats["requests"] += 1
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            stats["errors"] += 1
+            breaker.record_failure()
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            stats["latency_total"] += elapsed
+            stats["latency_max"] = max(stats["latency_max"], elapsed)
+            self.latency_histograms[endpoint].observe(elapsed)
+        retries = response.raw.retries.history if response.raw is not None and response.raw.retries else ()
+        stats["retries"] += len(retries)
+        stats["bytes"] += len(response.content)
+        if response.ok:
+            breaker.record_success()
+        else:
+            stats["errors"] += 1
+            breaker.record_failure()
+        return response
+
+    def format_stats(self) -> str:
+        lines = []
+        for endpoint, stats in sorted(self.stats.items()):
+            requests_count = int(stats["requests"])
+            avg_latency = stats["latency_total"] / requests_count if requests_count else 0.0
+            lines.append(
+                f"{endpoint}: {requests_count} requests, {int(stats['errors'])} errors, {int(stats['retries'])} retries, "
+                f"{int(stats['rejected'])} rejected by circuit breaker, avg {avg_latency:.2f}s, "
+                f"max {stats['latency_max']:.2f}s, {int(stats['bytes'])} bytes")
+        return "\n".join(lines)
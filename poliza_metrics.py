@@ -0,0 +1,218 @@
+"""
+Instrumentation of the poliza_api pipeline: depth of the request queues over time, time spent by
+the requests in each status, job processing and HTTP latency histograms, bytes and retries.
+Exported to a periodically rewritten JSON or Prometheus text file and as an end of run summary
+"""
+import os
+import json
+import time
+from collections import defaultdict, deque
+
+# Upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+JOB_BUCKETS = (30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+# Enough for 12h of samples at the default 15s reporting interval
+MAX_QUEUE_SAMPLES = 2880
+
+QUEUES = ("initial", "active", "pending_downloads")
+
+COUNTER_HELP = {
+    "queue_full": "Times a request waited because the active queue was full",
+    "post_errors": "ProcesaPoliza requests that didn't start a job",
+    "downloads": "Payloads downloaded and written",
+    "download_retries": "Payload downloads that failed and were queued again",
+    "download_circuit_waits": "Payload downloads put back because the Poliza circuit was open",
+    "download_failures": "Payloads given up on after MAX_DOWNLOAD_ATTEMPTS",
+}
+HTTP_STAT_HELP = {
+    "requests": "HTTP requests sent",
+    "errors": "HTTP requests that failed or returned an error status",
+    "retries": "HTTP retries done by the session",
+    "rejected": "HTTP requests rejected by the circuit breaker",
+    "bytes": "Response body bytes received",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile, inf if it falls in the last bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.total, "count": self.count}
+
+
+class PipelineMetrics:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.queue_samples = deque(maxlen=MAX_QUEUE_SAMPLES)
+        self.queue_max = dict.fromkeys(QUEUES, 0)
+        self.status_seconds = defaultdict(float)
+        self.job_seconds = Histogram(JOB_BUCKETS)
+        self.counters = defaultdict(int)
+        # id(request) -> (status, monotonic time it entered that status)
+        self._request_status = {}
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def sample_queues(self, initial: int, active: int, pending_downloads: int):
+        depths = dict(zip(QUEUES, (initial, active, pending_downloads)))
+        self.queue_samples.append((round(self.elapsed(), 3), initial, active, pending_downloads))
+        for queue, depth in depths.items():
+            self.queue_max[queue] = max(self.queue_max[queue], depth)
+
+    def count(self, counter: str, value=1):
+        self.counters[counter] += value
+
+    def set_status(self, req, status):
+        """Record that req is now in status, closing the time spent in its previous one. The time
+        between a request going ACTIVE and leaving it is the job processing time on VG's side"""
+        now = time.monotonic()
+        previous = self._request_status.get(id(req))
+        if previous and previous[0] == status:
+            return
+        if previous:
+            self._close_status(previous, now)
+        self._request_status[id(req)] = (status, now)
+
+    def finish_request(self, req):
+        previous = self._request_status.pop(id(req), None)
+        if previous:
+            self._close_status(previous, time.monotonic())
+
+    def _close_status(self, previous, now):
+        status, since = previous
+        self.status_seconds[status.name] += now - since
+        if status.name == "ACTIVE":
+            self.job_seconds.observe(now - since)
+
+    def _open_status_seconds(self) -> dict:
+        """status_seconds including the requests still in a status"""
+        now = time.monotonic()
+        status_seconds = defaultdict(float, self.status_seconds)
+        for status, since in self._request_status.values():
+            status_seconds[status.name] += now - since
+        return status_seconds
+
+    def to_dict(self, http_client=None) -> dict:
+        last_sample = self.queue_samples[-1] if self.queue_samples else (0, 0, 0, 0)
+        data = {
+            "elapsed": round(self.elapsed(), 3),
+            "queues": {queue: {"current": last_sample[i + 1], "max": self.queue_max[queue]}
+                       for i, queue in enumerate(QUEUES)},
+            "queue_samples": {"columns": ["elapsed"] + list(QUEUES), "values": list(self.queue_samples)},
+            "status_seconds": dict(self._open_status_seconds()),
+            "job_seconds": self.job_seconds.to_dict(),
+            "counters": dict(self.counters),
+            "http": {},
+        }
+        if http_client:
+            for endpoint, stats in sorted(http_client.stats.items()):
+                data["http"][endpoint] = dict(stats)
+                data["http"][endpoint]["latency"] = http_client.latency_histograms[endpoint].to_dict()
+        return data
+
+    def to_prometheus(self, http_client=None) -> str:
+        data = self.to_dict(http_client)
+        lines = _prometheus_header("poliza_elapsed_seconds", "gauge", "Seconds since the run started")
+        lines.append(f"poliza_elapsed_seconds {data['elapsed']}")
+        for name, key, help_text in (("poliza_queue_depth", "current", "Requests in each queue"),
+                                     ("poliza_queue_depth_max", "max", "Most requests seen in each queue")):
+            lines.extend(_prometheus_header(name, "gauge", help_text))
+            for queue, depths in data["queues"].items():
+                lines.append(f'{name}{{queue="{queue}"}} {depths[key]}')
+        lines.extend(_prometheus_header("poliza_request_status_seconds_total", "counter",
+                                        "Seconds spent by the requests in each status"))
+        for status, seconds in sorted(data["status_seconds"].items()):
+            lines.append(f'poliza_request_status_seconds_total{{status="{status}"}} {seconds:.3f}')
+        for counter, value in sorted(data["counters"].items()):
+            name = f"poliza_{counter}_total"
+            lines.extend(_prometheus_header(name, "counter", COUNTER_HELP.get(counter, counter.replace("_", " "))))
+            lines.append(f"{name} {value}")
+        lines.extend(_prometheus_header("poliza_job_seconds", "histogram", "Seconds a job stayed active on VG"))
+        lines.extend(_prometheus_histogram("poliza_job_seconds", "", self.job_seconds))
+        if data["http"]:
+            for stat in ("requests", "errors", "retries", "rejected", "bytes"):
+                name = f"poliza_http_{stat}_total"
+                lines.extend(_prometheus_header(name, "counter", HTTP_STAT_HELP[stat]))
+                for endpoint, stats in data["http"].items():
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {int(stats.get(stat, 0))}')
+            lines.extend(_prometheus_header("poliza_http_latency_seconds", "histogram",
+                                            "Seconds per HTTP request, retries included"))
+            for endpoint in data["http"]:
+                lines.extend(_prometheus_histogram("poliza_http_latency_seconds", f'endpoint="{endpoint}"',
+                                                   http_client.latency_histograms[endpoint]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, fname: str, http_client=None):
+        """Prometheus text format unless fname ends in .json. Written to a temporary file and renamed,
+        so a scraper never reads half a file"""
+        if fname.endswith(".json"):
+            content = json.dumps(self.to_dict(http_client))
+        else:
+            content = self.to_prometheus(http_client)
+        tmp_fname = fname + ".tmp"
+        with open(tmp_fname, "w") as metrics_file:
+            metrics_file.write(content)
+        os.replace(tmp_fname, fname)
+
+    def format_summary(self, http_client=None) -> str:
+        data = self.to_dict(http_client)
+        lines = [f"Elapsed {data['elapsed']:.0f}s"]
+        lines.append("Max queue depth: " + ", ".join(f"{queue} {depths['max']}" for queue, depths in data["queues"].items()))
+        if data["status_seconds"]:
+            lines.append("Request seconds by status: " + ", ".join(
+                f"{status} {seconds:.0f}s" for status, seconds in sorted(data["status_seconds"].items())))
+        if self.job_seconds.count:
+            lines.append(f"Job processing: {self.job_seconds.count} jobs, avg {self.job_seconds.total / self.job_seconds.count:.0f}s, "
+                         f"p50 <= {self.job_seconds.quantile(0.5)}s, p95 <= {self.job_seconds.quantile(0.95)}s")
+        if data["counters"]:
+            lines.append(", ".join(f"{counter} {value}" for counter, value in sorted(data["counters"].items())))
+        if http_client:
+            for endpoint, histogram in sorted(http_client.latency_histograms.items()):
+                lines.append(f"{endpoint} latency: p50 <= {histogram.quantile(0.5)}s, p95 <= {histogram.quantile(0.95)}s, "
+                             f"p99 <= {histogram.quantile(0.99)}s")
+        return "\n".join(lines)
+
+
+def _prometheus_header(name: str, kind: str, help_text: str) -> list[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+
+def _prometheus_histogram(name: str, label: str, histogram: Histogram) -> list[str]:
+    lines = []
+    prefix = f"{label}," if label else ""
+    cumulative = 0
+    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    suffix = f"{{{label}}}" if label else ""
+    lines.append(f"{name}_sum{suffix} {histogram.total:.3f}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+    return lines
@@ -0,0 +1,123 @@
+"""
+VG API payloads: the line format, its normalization and how payloads are stored on disk. Kept
+apart from poliza_api so the reconciliation scripts don't need to import the network client
+"""
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+from dataclasses import dataclass
+from polizafilter import API_LINE_FILTER
+
+PAYLOAD_SUFFIX = ".json.gz"
+CHECKSUM_SUFFIX = ".sha256"
+TMP_SUFFIX = ".tmp"
+
+# write_payload puts every "Poliza" entry on its own line right after this header, so they can be
+# parsed one by one while the file is being decompressed
+STREAMABLE_HEADER = '{"Poliza": ['
+
+
+@dataclass
+class PolizaAPILine:
+    cuenta: str
+    concepto: str
+    cargo: float
+    abono: float
+
+
+def read_json_lines(json, line_filter=API_LINE_FILTER):
+    return read_json_entries(json["Poliza"], line_filter)
+
+
+def read_json_entries(entries, line_filter=API_LINE_FILTER) -> list[PolizaAPILine]:
+    lines = []
+    for line in entries:
+        if line_filter(line["Concepto"]):
+            lines.append(PolizaAPILine(
+                cuenta=line["Cuenta"], concepto=line["Concepto"], cargo=float(line["Cargo"]), abono=float(line["Abono"])))
+    return lines
+
+
+def write_payload(fname: str, data: dict) -> str:
+    """Write a payload gzip compressed, with a sha256sum compatible sidecar. Both files are written
+    to a temp file and renamed into place, so readers never see a partially written payload.
+    Returns the sha256 of the compressed file"""
+    dirname = os.path.dirname(fname) or "."
+    fd, tmp_fname = tempfile.mkstemp(dir=dirname, prefix=".", suffix=TMP_SUFFIX)
+    try:
+        with os.fdopen(fd, "wb") as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode="wb", mtime=0) as gz_file:
+                gz_file.write(STREAMABLE_HEADER.encode())
+                for i, entry in enumerate(data.get("Poliza", [])):
+                    gz_file.write((("," if i else "") + "\n" + json.dumps(entry)).encode())
+                gz_file.write(b"\n]")
+                for key, value in data.items():
+                    if key != "Poliza":
+                        gz_file.write(f", {json.dumps(key)}: {json.dumps(value)}".encode())
+                gz_file.write(b"}\n")
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        checksum = file_sha256(tmp_fname)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+    fd, tmp_fname = tempfile.mkstemp(dir=dirname, prefix=".", suffix=TMP_SUFFIX)
+    with os.fdopen(fd, "w") as checksum_file:
+        checksum_file.write(f"{checksum}  {os.path.basename(fname)}\n")
+    os.replace(tmp_fname, fname + CHECKSUM_SUFFIX)
+    return checksum
+
+
+def file_sha256(fname: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(fname, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def verify_payload(fname: str) -> bool:
+    """Compare a payload against its checksum sidecar. Payloads without one are only checked
+    to be complete, parseable JSON"""
+    checksum_fname = fname + CHECKSUM_SUFFIX
+    if os.path.exists(checksum_fname):
+        with open(checksum_fname, "r") as checksum_file:
+            expected = checksum_file.read().split()[0]
+        return file_sha256(fname) == expected
+    try:
+        load_payload(fname)
+        return True
+    except (OSError, EOFError, ValueError):
+        return False
+
+
+def open_payload(fname: str, encoding="ISO-8859-1"):
+    """Open a payload as text, decompressing it on the fly if it is gzip compressed"""
+    if fname.endswith(".gz"):
+        return gzip.open(fname, "rt", encoding="utf-8")
+    return open(fname, "r", encoding=encoding)
+
+
+def load_payload(fname: str) -> dict:
+    with open_payload(fname) as payload_file:
+        return json.load(payload_file)
+
+
+def iter_payload_entries(fname: str):
+    """Yield the "Poliza" entries of a payload. Payloads written by write_payload are parsed line by
+    line while they are decompressed, anything else is loaded whole"""
+    with open_payload(fname) as payload_file:
+        first_line = payload_file.readline()
+        if first_line.rstrip("\n") != STREAMABLE_HEADER:
+            payload_file.seek(0)
+            yield from json.load(payload_file)["Poliza"]
+            return
+        for line in payload_file:
+            if line.startswith("]"):
+                return
+            yield json.loads(line.rstrip("\n").rstrip(","))
+        raise ValueError(f"{fname} is truncated")
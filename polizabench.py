@@ -0,0 +1,248 @@
+#!/bin/python3
+"""
+Micro and macro benchmarks of the reconciliation over deterministic, generated polizas.
+
+Every benchmark is timed (best of --repeat) and its peak memory measured with tracemalloc on a
+separate run. --save-baseline stores the results; later runs are compared against that baseline
+and fail if a benchmark got slower or uses more memory than the configured thresholds allow.
+
+    ./polizabench.py --save-baseline
+    ./polizabench.py --max-slowdown 1.2
+"""
+import sys
+import os
+import csv
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import datetime as dt
+from collections import namedtuple
+from poliza2csv import process_line, iter_txt_poliza_lines, SKIP_FIRST
+from polizadiff import (get_vg_poliza_lines, get_vx_poliza_lines, tag_no_account_lines, collapse_account,
+                        collapse_lines, line_has_match, get_possible_target, index_poliza_dirs, diff_poliza_day,
+                        write_dir_reports, reconcile, get_table_renderer, ReconcileOptions, CollapseRules,
+                        CollapsedAccount)
+
+BASELINE_FNAME = "polizabench_baseline.json"
+# A benchmark fails when it takes this many times its baseline time, or peak memory
+MAX_SLOWDOWN = 1.25
+MAX_MEMORY_GROWTH = 1.25
+# Runs this fast are too noisy to compare, they never fail the time threshold
+MIN_COMPARABLE_SECONDS = 0.01
+
+SEED = 20230101
+FIXTURE_DAYS = 30
+FIXTURE_ACCOUNTS = 40
+FIXTURE_CONCEPTS_PER_ACCOUNT = 6
+
+Benchmark = namedtuple("Benchmark", ["name", "kind", "run"])
+BenchResult = namedtuple("BenchResult", ["seconds", "peak_kb"])
+
+COMPARISON_HEADERS = ["Benchmark", "Tipo", "Base (s)", "Actual (s)", "Razon", "Base (KB)", "Actual (KB)", "Razon",
+                      "STATUS"]
+
+
+def generate_fixtures(fixtures_dir: str, days=FIXTURE_DAYS, seed=SEED) -> dict:
+    """Write VG (JSON and TXT) and VX polizas plus a collapse file for `days` days. The same seed
+    always produces the same files. Returns the paths the benchmarks need"""
+    rand = random.Random(seed)
+    vg_dir = os.path.join(fixtures_dir, "vg")
+    vx_dir = os.path.join(fixtures_dir, "vx")
+    os.makedirs(vg_dir, exist_ok=True)
+    os.makedirs(vx_dir, exist_ok=True)
+    accounts = ["4{:010d}".format(rand.randrange(10 ** 10)) for _ in range(FIXTURE_ACCOUNTS)]
+    concepts = {account: [f"CONCEPTO {account[-4:]} {n}" for n in range(FIXTURE_CONCEPTS_PER_ACCOUNT)]
+                for account in accounts}
+    collapse_fname = os.path.join(fixtures_dir, ".collapse")
+    with open(collapse_fname, "w") as collapse_file:
+        csv.writer(collapse_file).writerows([account, f"TODO {account}"] for account in accounts[::2])
+
+    first_day = dt.date(2023, 1, 1)
+    txt_fname = None
+    for day_num in range(days):
+        date_stamp = (first_day + dt.timedelta(days=day_num)).strftime("%Y%m%d")
+        vg_entries, vx_rows, txt_rows = [], [], []
+        for account in accounts:
+            for concept in concepts[account]:
+                amount = round(rand.uniform(10, 5000), 2)
+                is_credit = rand.random() < 0.7
+                vg_entries.append({"Cuenta": account, "Concepto": concept, "Cargo": 0.0 if is_credit else amount,
+                                   "Abono": amount if is_credit else 0.0})
+                vx_amount = amount if rand.random() < 0.85 else round(amount + rand.uniform(-20, 20), 2)
+                _type = "a" if is_credit else "c"
+                sign = "-" if is_credit else ""
+                vx_rows.append([account, concept, f"{sign}{vx_amount:.2f}{_type}"])
+                txt_rows.append(f"{account}{concept:<50}{sign + format(amount, '.2f') + _type:>20}")
+        with open(os.path.join(vg_dir, f"POLIZAINGRESOS_{date_stamp}.json"), "w") as vg_file:
+            json.dump({"Poliza": vg_entries}, vg_file)
+        with open(os.path.join(vx_dir, f"POLIZAINGRESOS_VX{date_stamp}.csv"), "w") as vx_file:
+            writer = csv.writer(vx_file)
+            writer.writerow(["account", "concept", "amount"])
+            writer.writerows(vx_rows)
+        if txt_fname is None:
+            txt_fname = os.path.join(fixtures_dir, f"POLIZAINGRESOS_{date_stamp}.TXT")
+            with open(txt_fname, "w", encoding="ISO-8859-1") as txt_file:
+                txt_file.write("ENCABEZADO\nPOLIZA DE INGRESOS\n")
+                # A multi month export is the same records many times over
+                txt_file.write("\n".join(txt_rows * 200) + "\n")
+    return {"vg_dir": vg_dir, "vx_dir": vx_dir, "txt": txt_fname, "collapse": collapse_fname}
+
+
+def get_benchmarks(fixtures: dict, reports_dir: str) -> list[Benchmark]:
+    """The micro benchmarks run their function over the lines of every fixture day, so a run is long
+    enough to time reliably"""
+    days, _undated = index_poliza_dirs(fixtures["vg_dir"], fixtures["vx_dir"])
+    day_lines = [(tag_no_account_lines(get_vg_poliza_lines(day.vg_fname)),
+                  tag_no_account_lines(get_vx_poliza_lines(day.vx_fname))) for day in days.values()]
+    collapsed_day_lines = []
+    for lines_vg, lines_vx in day_lines:
+        all_accounts_rules = CollapseRules({line.account: CollapsedAccount(line.account, line.account)
+                                            for line in lines_vg + lines_vx})
+        collapsed_day_lines.append((collapse_lines(lines_vg, all_accounts_rules)[0],
+                                    collapse_lines(lines_vx, all_accounts_rules)[0]))
+    with open(fixtures["txt"], "r", encoding="ISO-8859-1") as txt_file:
+        txt_lines = txt_file.readlines()[SKIP_FIRST:]
+    options = ReconcileOptions(collapse_accounts=True, collapse_file=fixtures["collapse"])
+
+    def bench_process_line():
+        for raw_line in txt_lines:
+            process_line(raw_line)
+
+    def bench_iter_txt_poliza_lines():
+        for _line in iter_txt_poliza_lines(fixtures["txt"]):
+            pass
+
+    def bench_line_has_match():
+        for collapsed_vg, collapsed_vx in collapsed_day_lines:
+            for line in collapsed_vg:
+                line_has_match(line, collapsed_vx)
+
+    def bench_collapse_account():
+        for _lines_vg, lines_vx in day_lines:
+            for account in {line.account for line in lines_vx}:
+                collapse_account(lines_vx, account, account)
+
+    def bench_get_possible_target():
+        for lines_vg, lines_vx in day_lines:
+            for line in lines_vg:
+                get_possible_target(line, lines_vx)
+
+    def bench_single_file_diff():
+        for day in days.values():
+            reconcile(day.vg_fname, day.vx_fname, options)
+
+    def bench_dir_diff():
+        days, _undated = index_poliza_dirs(fixtures["vg_dir"], fixtures["vx_dir"])
+        day_results = [diff_poliza_day(date_stamp, get_vg_poliza_lines(day.vg_fname),
+                                       get_vx_poliza_lines(day.vx_fname), options)
+                       for date_stamp, day in days.items()]
+        write_dir_reports(day_results, os.path.join(reports_dir, "matches.csv"),
+                          os.path.join(reports_dir, "diffs.csv"))
+
+    return [
+        Benchmark("process_line", "micro", bench_process_line),
+        Benchmark("iter_txt_poliza_lines", "micro", bench_iter_txt_poliza_lines),
+        Benchmark("line_has_match", "micro", bench_line_has_match),
+        Benchmark("collapse_account", "micro", bench_collapse_account),
+        Benchmark("get_possible_target", "micro", bench_get_possible_target),
+        Benchmark("single_file_diff", "macro", bench_single_file_diff),
+        Benchmark("dir_diff", "macro", bench_dir_diff),
+    ]
+
+
+def run_benchmark(benchmark: Benchmark, repeat: int) -> BenchResult:
+    """Best wall time of `repeat` runs, then one more run under tracemalloc for the peak memory"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        benchmark.run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    try:
+        benchmark.run()
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return BenchResult(best, peak // 1024)
+
+
+def compare_results(results: dict, baseline: dict, max_slowdown=MAX_SLOWDOWN,
+                    max_memory_growth=MAX_MEMORY_GROWTH, kinds: dict = None) -> tuple[list[list], bool]:
+    """Comparison rows against the baseline and whether any benchmark went over a threshold"""
+    rows = []
+    failed = False
+    for name, result in results.items():
+        kind = (kinds or {}).get(name, "")
+        base = baseline.get(name)
+        if base is None:
+            rows.append([name, kind, "", "{:.4f}".format(result.seconds), "", "", result.peak_kb, "", "NEW"])
+            continue
+        time_ratio = result.seconds / base["seconds"] if base["seconds"] else 1.0
+        memory_ratio = result.peak_kb / base["peak_kb"] if base["peak_kb"] else 1.0
+        status = []
+        if time_ratio > max_slowdown and result.seconds >= MIN_COMPARABLE_SECONDS:
+            status.append("SLOWER")
+        if memory_ratio > max_memory_growth:
+            status.append("MORE MEMORY")
+        failed |= bool(status)
+        rows.append([name, kind, "{:.4f}".format(base["seconds"]), "{:.4f}".format(result.seconds),
+                     "{:.2f}".format(time_ratio), base["peak_kb"], result.peak_kb, "{:.2f}".format(memory_ratio),
+                     " ".join(status) or "OK"])
+    return rows, failed
+
+
+def load_baseline(fname: str) -> dict:
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, "r") as baseline_file:
+        return json.load(baseline_file)["benchmarks"]
+
+
+def save_baseline(fname: str, results: dict, args):
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "w") as baseline_file:
+        json.dump({"python": sys.version.split()[0], "days": args.days, "seed": args.seed, "repeat": args.repeat,
+                   "benchmarks": {name: result._asdict() for name, result in results.items()}},
+                  baseline_file, indent=2)
+    os.replace(tmp_fname, fname)
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--baseline", default=BASELINE_FNAME)
+    argparser.add_argument("--save-baseline", action="store_true",
+                           help="Store this run as the baseline instead of comparing against it")
+    argparser.add_argument("--max-slowdown", type=float, default=MAX_SLOWDOWN,
+                           help="Fail if a benchmark takes more than this many times its baseline time")
+    argparser.add_argument("--max-memory-growth", type=float, default=MAX_MEMORY_GROWTH,
+                           help="Fail if a benchmark's peak memory grows more than this many times its baseline")
+    argparser.add_argument("--repeat", type=int, default=5)
+    argparser.add_argument("--days", type=int, default=FIXTURE_DAYS)
+    argparser.add_argument("--seed", type=int, default=SEED)
+    argparser.add_argument("--only", action="append", help="Only run this benchmark (can be repeated)")
+    argparser.add_argument("--fixtures-dir", help="Keep the generated polizas here instead of a temporary directory")
+    args = argparser.parse_args(argv[1:])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fixtures = generate_fixtures(args.fixtures_dir or tmp_dir, args.days, args.seed)
+        benchmarks = [benchmark for benchmark in get_benchmarks(fixtures, tmp_dir)
+                      if not args.only or benchmark.name in args.only]
+        results = {benchmark.name: run_benchmark(benchmark, args.repeat) for benchmark in benchmarks}
+
+    kinds = {benchmark.name: benchmark.kind for benchmark in benchmarks}
+    if args.save_baseline:
+        save_baseline(args.baseline, results, args)
+        print(f"Baseline saved to {args.baseline}")
+    rows, failed = compare_results(results, {} if args.save_baseline else load_baseline(args.baseline),
+                                   args.max_slowdown, args.max_memory_growth, kinds)
+    print(get_table_renderer()(rows, headers=COMPARISON_HEADERS))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
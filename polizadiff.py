@@ -2,28 +2,63 @@
 """
 Produce a comparison between a villagroup poliza and our implementation of poliza
 """
-from poliza2csv import process_line, EXCLUDED_CONCEPTS, SKIP_FIRST, PolizaLine, process_amount, format_amount
+from poliza2csv import iter_txt_poliza_lines, PolizaLine, process_amount, format_amount
 import sys
 import csv
 import re
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, deque, Counter
 import logging
 import argparse
-import tabulate
 import datetime as dt
 import itertools
 from enum import Enum
+from dataclasses import dataclass
 import os
 import io
-import datetime as dt
-from poliza_api import PolizaAPILine, read_json_lines
+import time
+import bisect
+from poliza_payload import (PolizaAPILine, read_json_lines, read_json_entries, iter_payload_entries, CHECKSUM_SUFFIX,
+                            TMP_SUFFIX, PAYLOAD_SUFFIX)
+from polizafilter import VG_LINE_FILTER, VX_LINE_FILTER
 import json
 
 log = logging.getLogger(__name__)
 
 VAUXOO_SKIP_FIRST = 1
 
+DATE_STAMP_MATCHER = re.compile(r"(?P<date>\d{8})")
+VX_FNAME_MATCHER = re.compile(r"^POLIZAINGRESOS_VX(?P<date>\d{8})\.csv$")
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
 CollapsedAccount = namedtuple("CollapsedAccount", ["account", "description"])
+# Compiled .collapse file: account -> CollapsedAccount, in the order rules are applied
+CollapseRules = namedtuple("CollapseRules", ["by_account"])
+
+COLLAPSE_FNAME = ".collapse"
+_collapse_rules_cache = {}
+
+
+# Maximum difference for two amounts on different accounts to be reported as a close match
+CLOSE_MATCH_MARGIN = 5.0
+
+# Everything get_matches needs to know, so it can be called without an argparse namespace
+ReconcileOptions = namedtuple(
+    "ReconcileOptions",
+    ["collapse_accounts", "collapse_file", "strict", "show_close_matches", "show_inverted_sign_matches",
+     "close_match_margin", "sister_file"],
+    defaults=[False, COLLAPSE_FNAME, False, False, False, CLOSE_MATCH_MARGIN, None])
+
+# Maximum amount left over for two account diffs to be considered the same amount moved between them
+SISTER_SWAP_TOLERANCE = 2.0
+# Two accounts whose diffs cancel each other out. moved_cents is account_a's VX - VG diff, like account diffs
+SisterSwap = namedtuple("SisterSwap", ["type", "account_a", "account_b", "moved_cents", "residual_cents"])
+_sister_groups_cache = {}
+
+# The same line posted on different days in VG and VX. offset is the VX day minus the VG day
+ShiftedMatch = namedtuple("ShiftedMatch", ["vg_date_stamp", "vx_date_stamp", "offset", "vg_line", "vx_line"])
+
+# Lines that only exist on source and whose removal makes an account match its target
+OddAmount = namedtuple("OddAmount", ["line", "source", "target"])
 
 
 class OpMode(Enum):
@@ -40,43 +75,67 @@ def api_line_to_poliza_line(api_line: PolizaAPILine) -> PolizaLine:
 
 
 def get_collapsed_accounts(fname: str) -> list:
+    return list(load_collapse_rules(fname).by_account.values())
+
+
+def load_collapse_rules(fname: str = COLLAPSE_FNAME) -> CollapseRules:
+    """Parse a collapse file into a CollapseRules. Results are cached by path and mtime, so
+    repeated calls (i.e. once per day on DIR_DIFF) don't re-read the file unless it changes.
+    If an account appears more than once, the last row wins"""
+    cache_key = os.path.abspath(fname)
     try:
-        collapsed_accounts = []
-        with open(fname, "r") as file:
-            reader = csv.reader(file)
-            for row in reader:
-                if not row[0].startswith("#"):
-                    collapsed_accounts.append(CollapsedAccount(*row))
-        return collapsed_accounts
-    except:
-        return []
+        mtime = os.stat(fname).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    cached = _collapse_rules_cache.get(cache_key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    if mtime is None:
+        log.warning("Collapse file %s not found, no accounts will be collapsed", fname)
+        _collapse_rules_cache[cache_key] = (mtime, CollapseRules({}))
+        return _collapse_rules_cache[cache_key][1]
+
+    by_account = {}
+    with open(fname, "r") as file:
+        reader = csv.reader(file)
+        for row_num, row in enumerate(reader, start=1):
+            if not row or row[0].startswith("#"):
+                continue
+            if len(row) != 2:
+                log.warning("%s:%d: expected 'account,description', got %s", fname, row_num, row)
+                continue
+            # Re-insert so rules keep the order of their last appearance
+            by_account.pop(row[0], None)
+            by_account[row[0]] = CollapsedAccount(*row)
+    rules = CollapseRules(by_account)
+    _collapse_rules_cache[cache_key] = (mtime, rules)
+    return rules
 
 
 def extract_poliza_date_from_fname(fname: str) -> str:
-    dt_matcher = re.compile(r"(?P<date>\d{8})")
-    dt_match = dt_matcher.search(fname)
+    dt_match = DATE_STAMP_MATCHER.search(fname)
     return dt_match["date"] if dt_match else None
 
 
 def get_vg_poliza_lines(poliza_vg) -> list[PolizaLine]:
-    with open(poliza_vg, "r", encoding="ISO-8859-1") as poliza_vg_file:
-        try:
-            # Assume json format
-            data = json.load(poliza_vg_file)
-            api_lines = read_json_lines(data)
-            lines_vg = map(api_line_to_poliza_line, api_lines)
-            return remove_unsupported_vg_lines(lines_vg)
-        except:
-            for _ in range(SKIP_FIRST):
-                next(poliza_vg_file)
-            # list of PolizaLine
-            lines_vg = map(process_line, poliza_vg_file)
-            # Remove None's
-            lines_vg = filter(lambda line: line, lines_vg)
-            # Remove excluded concepts
-            lines_vg: list[PolizaLine] = list(
-                filter(lambda line: line.concept not in EXCLUDED_CONCEPTS, lines_vg))
-            return remove_unsupported_vg_lines(lines_vg)
+    """Read a VG poliza, either an API payload (plain or gzip compressed JSON) or a TXT export"""
+    if is_json_poliza(poliza_vg):
+        api_lines = read_json_entries(iter_payload_entries(poliza_vg), line_filter=VG_LINE_FILTER)
+        return list(map(api_line_to_poliza_line, api_lines))
+    return list(iter_txt_poliza_lines(poliza_vg, line_filter=VG_LINE_FILTER))
+
+
+def is_json_poliza(fname: str) -> bool:
+    if fname.endswith(".gz"):
+        return True
+    with open(fname, "rb") as poliza_file:
+        return poliza_file.read(64).lstrip().startswith(b"{")
+
+
+def json_to_poliza_lines(data: dict) -> list[PolizaLine]:
+    """Normalize an already loaded VG API payload"""
+    api_lines = read_json_lines(data, line_filter=VG_LINE_FILTER)
+    return list(map(api_line_to_poliza_line, api_lines))
 
 
 def get_vx_poliza_lines(poliza_vx) -> list[PolizaLine]:
@@ -84,35 +143,40 @@ def get_vx_poliza_lines(poliza_vx) -> list[PolizaLine]:
         poliza_reader = csv.reader(poliza_vauxoo, delimiter=",", quotechar='"')
         for _ in range(VAUXOO_SKIP_FIRST):
             next(poliza_reader)
-        lines_vauxoo: list[PolizaLine] = map(
-            process_vauxoo_line, poliza_reader)
-        lines_vauxoo: list[PolizaLine] = list(
-            filter(lambda line: line.concept not in EXCLUDED_CONCEPTS, lines_vauxoo))
-        return remove_empty_lines(lines_vauxoo)
+        lines_vauxoo = []
+        for row in poliza_reader:
+            line = process_vauxoo_line(row)
+            if VX_LINE_FILTER(line.concept, line.amount):
+                lines_vauxoo.append(line)
+        return lines_vauxoo
 
 
-def get_matches(lines_src, lines_target, args, src_lbl="SOURCE", target_lbl="TARGET"):
+def get_matches(lines_src, lines_target, options: ReconcileOptions, src_lbl="SOURCE", target_lbl="TARGET"):
 
     extracted_lines_source = {}
     extracted_lines_target = {}
 
-    if args.collapse_accounts:
-        collapsed_accounts = get_collapsed_accounts(".collapse")
-        for account, descr in collapsed_accounts:
-            lines_src, extracted_src, _new_credit, _new_debit = collapse_account(
-                lines_src, account, descr)
-            extracted_lines_source[account] = extracted_src
-            lines_target, extracted_target, _new_credit, _new_debit = collapse_account(
-                lines_target, account, descr)
-            extracted_lines_target[account] = extracted_target
+    if options.collapse_accounts:
+        collapse_rules = load_collapse_rules(options.collapse_file)
+        lines_src, extracted_lines_source = collapse_lines(lines_src, collapse_rules)
+        lines_target, extracted_lines_target = collapse_lines(lines_target, collapse_rules)
 
     matched_lines = []
     unmatched_lines = []
 
     odd_amounts_buffer = []
+    near_misses = []
+
+    amount_index = None
+    if options.show_close_matches or options.show_inverted_sign_matches:
+        amount_index = AmountIndex(lines_src)
 
     for line_target in lines_target:
-        if matched_line := line_has_match(line_target, lines_src, strict=args.strict, show_close_matches=args.show_close_matches):
+        if amount_index:
+            near_misses.extend(amount_index.get_near_misses(
+                line_target, margin=options.close_match_margin,
+                close=options.show_close_matches, inverted_sign=options.show_inverted_sign_matches))
+        if matched_line := line_has_match(line_target, lines_src, strict=options.strict):
             matched_lines.append((line_target, matched_line))
         else:
             # If line was unmatched and is accumulated line, check if by extracting one or some amounts, we could
@@ -131,7 +195,68 @@ def get_matches(lines_src, lines_target, args, src_lbl="SOURCE", target_lbl="TAR
                 line_target, lines_src) or None
             unmatched_lines.append((line_target, possible_target))
 
-    return matched_lines, unmatched_lines, odd_amounts_buffer
+    return matched_lines, unmatched_lines, odd_amounts_buffer, near_misses
+
+
+NearMiss = namedtuple("NearMiss", ["kind", "target", "source", "diff"])
+
+def amount_cents(line: PolizaLine) -> int:
+    return round(float(line.sign + line.amount) * 100)
+
+
+class AmountIndex:
+    """Lines sorted by type and signed amount in cents, so all lines within a margin of
+    an amount are found with a binary search instead of scanning every line"""
+
+    def __init__(self, lines: list[PolizaLine]):
+        self.cents_by_type = {}
+        self.lines_by_type = {}
+        for cents, line in sorted(((amount_cents(line), line) for line in lines), key=lambda t: t[0]):
+            self.cents_by_type.setdefault(line.type, []).append(cents)
+            self.lines_by_type.setdefault(line.type, []).append(line)
+
+    def within(self, _type: str, cents: int, margin_cents: int) -> list[PolizaLine]:
+        """Lines of type _type whose amount is strictly within margin_cents of cents"""
+        cents_list = self.cents_by_type.get(_type)
+        if not cents_list:
+            return []
+        lo = bisect.bisect_right(cents_list, cents - margin_cents)
+        hi = bisect.bisect_left(cents_list, cents + margin_cents)
+        return self.lines_by_type[_type][lo:hi]
+
+    def get_near_misses(self, line: PolizaLine, margin=CLOSE_MATCH_MARGIN, close=True, inverted_sign=False) -> list[NearMiss]:
+        """Lines on other accounts (as accounts_match sees them) whose amount is within margin of line's amount (close), or of
+        line's amount with its sign inverted (inverted sign)"""
+        near_misses = []
+        cents = amount_cents(line)
+        margin_cents = round(margin * 100)
+        lookups = []
+        if close:
+            lookups.append(("CLOSE", cents))
+        if inverted_sign and cents:
+            lookups.append(("INVERTED SIGN", -cents))
+        for kind, lookup_cents in lookups:
+            for candidate in self.within(line.type, lookup_cents, margin_cents):
+                if accounts_match(candidate.account, line.account):
+                    continue
+                near_misses.append(NearMiss(kind, line, candidate, (amount_cents(candidate) - lookup_cents) / 100))
+        return near_misses
+
+
+NEAR_MISS_HEADERS = ["KIND", "VG account", "VG concept", "VG amount", "VX amount", "VX concept", "VX account", "DIFF"]
+
+
+def format_near_misses(near_misses: list[NearMiss], fast_tables=False) -> str:
+    render_table = get_table_renderer(fast_tables)
+    return render_table(get_near_miss_table(near_misses), headers=NEAR_MISS_HEADERS)
+
+
+def get_near_miss_table(near_misses: list[NearMiss]) -> list[list[str]]:
+    return [[near_miss.kind, near_miss.target.account, near_miss.target.concept,
+             format_amount((near_miss.target.sign, near_miss.target.amount, near_miss.target.type)),
+             format_amount((near_miss.source.sign, near_miss.source.amount, near_miss.source.type)),
+             near_miss.source.concept, near_miss.source.account, "{:.2f}".format(near_miss.diff)]
+            for near_miss in near_misses]
 
 
 TABLE_HEADERS = ["STATUS", "VG account", "VG concept",
@@ -147,12 +272,54 @@ def main(argv):
         "--strict", help="Doesn't permit a match if concepts don't align", action="store_true")
     argparser.add_argument("--show-close-matches", "-s",
                            help="Show amounts that almost align by MARGIN", action="store_true")
+    argparser.add_argument("--close-match-margin", type=float, default=CLOSE_MATCH_MARGIN, metavar="MARGIN",
+                           help="Margin for --show-close-matches and --show-inverted-sign-matches (default: 5.0)")
     argparser.add_argument(
         "--collapse-accounts", help="Collapse accounts specified in .collapse", action="store_true")
+    argparser.add_argument("--collapse-file", default=COLLAPSE_FNAME,
+                           help="Collapse rules file used by --collapse-accounts (default: .collapse)")
     argparser.add_argument("--show-inverted-sign-matches",
                            help="Show amounts that match but have their sign inverted", action="store_true")
+    argparser.add_argument("--sister-file",
+                           help="Report accounts of the same group ('account,group' rows) whose diffs cancel out as "
+                                "swapped sister accounts")
     argparser.add_argument("--csv-match-results", action="store_true")
+    argparser.add_argument("--json", action="store_true",
+                           help="SINGLE_FILE_DIFF: print the result as JSON instead of tables")
+    argparser.add_argument("--filter-stats", action="store_true",
+                           help="Print how many lines each filter rule removed")
+    argparser.add_argument("--fast-tables", action="store_true",
+                           help="Render result tables with the built-in fixed-width renderer instead of tabulate")
+    argparser.add_argument("--from", dest="date_from", type=parse_date_stamp,
+                           help="DIR_DIFF: first day to compare (YYYYMMDD or YYYY-MM-DD, inclusive)")
+    argparser.add_argument("--to", dest="date_to", type=parse_date_stamp,
+                           help="DIR_DIFF: last day to compare (YYYYMMDD or YYYY-MM-DD, inclusive)")
+    argparser.add_argument("--weekday", type=parse_weekdays,
+                           help="DIR_DIFF: only compare these weekdays, i.e. mon,fri or 0,4")
+    argparser.add_argument("--month", type=parse_months,
+                           help="DIR_DIFF: only compare these months, i.e. 1,12")
+    argparser.add_argument("--list-days", action="store_true",
+                           help="DIR_DIFF: list indexed days and which side they exist on, then exit")
+    argparser.add_argument("--sweep-tolerances", type=parse_tolerances, metavar="TOLERANCES",
+                           help="DIR_DIFF: account match pctg for each of these tolerances, i.e. 0.5,1,2,5")
+    argparser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                           help="DIR_DIFF: only compare the i-th of N day partitions and write its partial results "
+                                "for polizashard.py merge instead of the reports")
+    argparser.add_argument("--shard-dir", default=".", help="Directory --shard writes its results to")
+    argparser.add_argument("--window", type=int, default=0, metavar="K",
+                           help="DIR_DIFF: pair unmatched lines with the same account and amount up to K days apart "
+                                "as shifted matches")
+    argparser.add_argument("--watch", action="store_true",
+                           help="Keep running on DIR_DIFF and recompute only the days whose polizas change")
+    argparser.add_argument("--watch-interval", type=float, default=0.5,
+                           help="Seconds between directory polls in --watch mode")
     args = argparser.parse_args()
+    if args.shard and args.watch:
+        argparser.error("--shard can't be used with --watch")
+    if args.window < 0:
+        argparser.error("--window must be 0 or more days")
+    if args.window and (args.shard or args.watch):
+        argparser.error("--window can't be used with --shard or --watch")
 
     poliza_vg = args.POLIZA_VILLAGROUP
     poliza_vauxoo = args.POLIZA_VX
@@ -164,20 +331,20 @@ def main(argv):
     elif os.path.isfile(poliza_vg) and os.path.isfile(poliza_vauxoo):
         opmode = OpMode.SINGLE_FILE_DIFF
 
+    options = get_reconcile_options(args)
+
     if opmode == OpMode.SINGLE_FILE_DIFF:
-        lines_vx = get_vx_poliza_lines(poliza_vauxoo)
-        lines_vg = get_vg_poliza_lines(poliza_vg)
-        lines_vx = tag_no_account_lines(lines_vx)
-        lines_vg = tag_no_account_lines(lines_vg)
-        #  matched_lines, unmatched_lines, odd_amounts_buffer = get_matches(lines_vg, lines_vx, args, src_lbl="POLIZA VG", target_lbl="POLIZA VX")
-        matched_lines, unmatched_lines, odd_amounts_buffer = get_matches(
-            lines_vx, lines_vg, args, src_lbl="POLIZA VX", target_lbl="POLIZA VG")
+        result = reconcile(poliza_vg, poliza_vauxoo, options)
+        matched_lines, unmatched_lines = result.matched, result.unmatched
+
+        if args.json:
+            print(result.to_json())
+            return
 
         CSV_RESULT_FILE = "POLIZA_DIFF_%s.csv"
 
         if args.csv_match_results:
-            poliza_date = extract_poliza_date_from_fname(poliza_vg)
-            with open(CSV_RESULT_FILE % poliza_date, "w") as outfile:
+            with open(CSV_RESULT_FILE % result.date_stamp, "w") as outfile:
                 writer = csv.writer(outfile, csv.QUOTE_MINIMAL)
                 writer.writerow(["account", "concept", "VG-VX match"])
                 for vx, vg in matched_lines:
@@ -186,111 +353,527 @@ def main(argv):
                     writer.writerow([vx.account, vx.concept, False])
 
         ok_msg, err_msg = tabulate_results(
-            matched_lines, unmatched_lines, odd_amounts_buffer, headers=TABLE_HEADERS)
+            matched_lines, unmatched_lines, result.odd_amounts, headers=TABLE_HEADERS, fast_tables=args.fast_tables)
         print(ok_msg)
         print(err_msg)
+        if result.near_misses:
+            print(format_near_misses(result.near_misses, args.fast_tables))
+        if args.filter_stats:
+            print_filter_stats()
+
+    elif opmode == OpMode.DIR_DIFF and args.watch:
+        watch_dirs(poliza_vg, poliza_vauxoo, args, options)
 
     elif opmode == OpMode.DIR_DIFF:
-        global_matches, global_non_matches = 0, 0
-        candidates_list_non_matches = []
-        poliza_fnames = os.listdir(poliza_vg)
-        sorted_fnames = sorted(poliza_fnames)
-        matches_by_day_by_acc = {}
-        diff_by_day_by_acc = {}
-        all_accounts = set()
-        # Iter through files in vg dir
-        for vg_poliza_fname in sorted_fnames:
-            # Extract poliza date stamp
-            current_date_stdout = io.StringIO("")
-            poliza_date_stamp = extract_poliza_date_from_fname(vg_poliza_fname)
-            if not poliza_date_stamp:
-                print(f"SKIP: {vg_poliza_fname}")
+        # Only the summaries are kept, the lines of a day are dropped once it is reconciled
+        day_summaries = {}
+        days, undated = index_poliza_dirs(poliza_vg, poliza_vauxoo, get_day_filter(args))
+        if args.list_days:
+            print_poliza_days(days)
+            return
+        if args.sweep_tolerances:
+            sweep_tolerances(days, args.sweep_tolerances, args.fast_tables)
+            return
+        for fname in undated:
+            print(f"SKIP: {fname}")
+        shift_window = ShiftWindow(args.window) if args.window else None
+        shifted_stats = {}
+        for poliza_date_stamp, day in days.items():
+            if not day.vg_fname:
                 continue
-
-            vg_poliza_fname = os.path.join(poliza_vg, vg_poliza_fname)
-
-            target_vx_fname = f"POLIZAINGRESOS_VX{poliza_date_stamp}.csv"
-            target_vx_fname = os.path.join(poliza_vauxoo, target_vx_fname)
             # Look for matching vx poliza
-            if not os.path.exists(target_vx_fname):
-                print(f"SKIP: {target_vx_fname} not found")
+            if not day.vx_fname:
+                print(f"SKIP: {get_vx_poliza_fname(poliza_vauxoo, poliza_date_stamp)} not found")
                 continue
-            lines_vx = get_vx_poliza_lines(target_vx_fname)
-            lines_vg = get_vg_poliza_lines(vg_poliza_fname)
-
-            lines_vx = tag_no_account_lines(lines_vx)
-            lines_vg = tag_no_account_lines(lines_vg)
-
-            matched_lines, unmatched_lines, odd_amounts_buffer = get_matches(
-                lines_vx, lines_vg, args, src_lbl="POLIZA VX", target_lbl="POLIZA VG")
-            ok_msg, err_msg = tabulate_results(
-                matched_lines, unmatched_lines, odd_amounts_buffer, headers=TABLE_HEADERS)
-            current_date = dt.datetime.strptime(poliza_date_stamp, "%Y%m%d")
-            for tgt, match in matched_lines:
-                all_accounts.add(tgt.account)
-            for tgt, match in unmatched_lines:
-                all_accounts.add(tgt.account)
-            print(current_date.strftime("%a %d %b %Y"), file=current_date_stdout)
-            print(f"COMPARING: {vg_poliza_fname} vs. {target_vx_fname}", file=current_date_stdout)
-            print(err_msg, file=current_date_stdout)
-            matches, non_matches, match_pctg = get_match_stats(
-                matched_lines, unmatched_lines)
-            candidates_list_non_matches.append(unmatched_lines)
-            global_matches += matches
-            global_non_matches += non_matches
-
-            if match_pctg < 1:
-                print(current_date_stdout.getvalue())
-
-            matched_by_acc, unmatched_by_acc, _odd_amounts = get_matches_by_account(
-                lines_vg, lines_vx)
-            # If an account is in neither, assume a match
-            matches_by_acc = defaultdict(lambda: 0)
-            diffs_by_acc = dict()
-            diffs_by_acc.update(get_diffs_by_account(matched_by_acc))
-            diff_by_day_by_acc[current_date.strftime(
-                    "%d-%m-%Y")] = diffs_by_acc
-            for tgt, src in matched_by_acc + unmatched_by_acc:
-                if src is None:
-                    # No match
-                    matches_by_acc[tgt.account] = 1
-                else:
-                    # Match
-                    matches_by_acc[tgt.account] = 0
-                matches_by_day_by_acc[current_date.strftime(
-                    "%d-%m-%Y")] = matches_by_acc
-
-        global_match_pctg = global_matches / \
-            (global_matches + global_non_matches)
-        common_unmatched_concepts = find_common_unmatched_concepts(
-            candidates_list_non_matches)
-        print("Global match pctg: {:.2f}%".format(global_match_pctg * 100))
-        print("\n\n")
-        print("These concepts were the most unmatched")
-        for common_unmatched_concept, count in common_unmatched_concepts:
-            print(f"{common_unmatched_concept} ({count} misses)")
-
-        # Ensure constant ordering
-        all_accounts = list(sorted(list(all_accounts)))
-        report_fname = "REPORTE_MATCHES_POLIZA.csv"
-        diff_report_fname = "REPORTE_DIFFS_POLIZA.csv"
-        with open(report_fname, "w") as report, open(diff_report_fname, "w") as diffs:
-            report_writer = csv.writer(report)
-            diff_writer = csv.writer(diffs)
-            report_writer.writerow(["Fecha"] + all_accounts)
-            diff_writer.writerow(["Fecha"] + all_accounts)
-            for day, day_acc_results in matches_by_day_by_acc.items():
-                day_results = [day] + [day_acc_results[account]
-                                       for account in all_accounts]
-                report_writer.writerow(day_results)
-            for day, acc_diffs in diff_by_day_by_acc.items():
-                day_diffs = [day] + [acc_diffs.get(account, 0.0) for account in all_accounts]
-                diff_writer.writerow(day_diffs)
+            lines_vx = get_vx_poliza_lines(day.vx_fname)
+            lines_vg = get_vg_poliza_lines(day.vg_fname)
+
+            day_result = diff_poliza_day(
+                poliza_date_stamp, lines_vg, lines_vx, options)
+            day_summaries[poliza_date_stamp] = summarize_day(day_result)
+
+            if day_result.match_pctg < 1:
+                print(format_day_result(day_result, day.vg_fname, day.vx_fname, args.fast_tables))
+            if shift_window:
+                day_shifts = shift_window.add_day(day_result, lines_vx, options)
+                for shifted in day_shifts:
+                    print(format_shifted_match(shifted))
+                    day_summaries[shifted.vg_date_stamp] = apply_shifted_match(
+                        day_summaries[shifted.vg_date_stamp], shifted)
+                    add_shifted_match_stats(shifted_stats, shifted)
+
+        day_summaries = list(day_summaries.values())
+        if args.shard:
+            # Reports and global stats are produced by polizashard.py merge
+            from polizashard import write_shard, get_shard_fname
+            shard_fname = get_shard_fname(args.shard_dir, args.shard)
+            write_shard(shard_fname, args.shard, day_summaries)
+            print("Shard {}/{}: {} days written to {}".format(*args.shard, len(day_summaries), shard_fname))
+        elif not day_summaries:
+            # Keep the reports of the last run instead of overwriting them with empty ones
+            print("No days selected: no day matching --from/--to/--weekday/--month has both polizas")
+        else:
+            print_day_summaries_stats(day_summaries)
+            print_sister_swaps(day_summaries, args.fast_tables)
+            if shift_window:
+                print_shifted_matches(shifted_stats, args.window, args.fast_tables)
+            write_day_summaries_reports(day_summaries)
+        if args.filter_stats:
+            print_filter_stats()
 
     else:
         print("ERROR: Unimplemented")
 
 
+DayResult = namedtuple("DayResult", ["date_stamp", "matched_lines", "unmatched_lines", "odd_amounts_buffer",
+                                     "matches_by_acc", "diffs_by_acc", "match_pctg", "near_misses", "sister_swaps"])
+
+# What the global stats and the DIR_DIFF reports need from a DayResult, small enough to be written
+# to a shard file and merged later
+DaySummary = namedtuple("DaySummary", ["date_stamp", "accounts", "matches", "non_matches", "unmatched_concepts",
+                                       "matches_by_acc", "diffs_by_acc", "sister_swaps"])
+
+REPORT_FNAME = "REPORTE_MATCHES_POLIZA.csv"
+DIFF_REPORT_FNAME = "REPORTE_DIFFS_POLIZA.csv"
+
+
+def get_vx_poliza_fname(poliza_vauxoo_dir: str, poliza_date_stamp: str) -> str:
+    return os.path.join(poliza_vauxoo_dir, f"POLIZAINGRESOS_VX{poliza_date_stamp}.csv")
+
+
+def get_reconcile_options(args) -> ReconcileOptions:
+    return ReconcileOptions(**{field: getattr(args, field) for field in ReconcileOptions._fields})
+
+
+@dataclass
+class ReconcileResult:
+    """Outcome of reconciling one VG poliza (target) against one VX poliza (source)"""
+    date_stamp: str
+    # (VG line, VX line)
+    matched: list[tuple]
+    # (VG line, closest VX line or None)
+    unmatched: list[tuple]
+    odd_amounts: list[OddAmount]
+    near_misses: list[NearMiss]
+    # Account -> VX - VG, for accounts present on both sides. Same sign as REPORTE_DIFFS_POLIZA.csv
+    account_diffs: dict
+    # Account -> 1 if the account totals didn't match, 0 otherwise
+    account_mismatches: dict
+    match_pctg: float
+    sister_swaps: list[SisterSwap]
+
+    @classmethod
+    def from_day_result(cls, day_result: DayResult):
+        return cls(day_result.date_stamp, day_result.matched_lines, day_result.unmatched_lines,
+                   day_result.odd_amounts_buffer, day_result.near_misses, dict(day_result.diffs_by_acc),
+                   dict(day_result.matches_by_acc), day_result.match_pctg, day_result.sister_swaps)
+
+    def to_dict(self) -> dict:
+        def line_dict(line):
+            return line._asdict() if line else None
+        matches, non_matches, _match_pctg = get_match_stats(self.matched, self.unmatched)
+        return {
+            "date": self.date_stamp,
+            "matches": matches,
+            "non_matches": non_matches,
+            "match_pctg": self.match_pctg,
+            "matched": [{"vg": line_dict(vg), "vx": line_dict(vx)} for vg, vx in self.matched],
+            "unmatched": [{"vg": line_dict(vg), "possible_vx": line_dict(vx)} for vg, vx in self.unmatched],
+            "odd_amounts": [{"line": line_dict(odd.line), "source": odd.source, "target": odd.target}
+                            for odd in self.odd_amounts],
+            "near_misses": [{"kind": near_miss.kind, "vg": line_dict(near_miss.target),
+                             "vx": line_dict(near_miss.source), "diff": near_miss.diff}
+                            for near_miss in self.near_misses],
+            "account_diffs": self.account_diffs,
+            "account_mismatches": self.account_mismatches,
+            "sister_swaps": [swap._asdict() for swap in self.sister_swaps],
+        }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+def reconcile(vg_source, vx_source, options: ReconcileOptions = None, date_stamp: str = None) -> ReconcileResult:
+    """Reconcile a VG poliza against a VX poliza without printing or writing anything.
+    vg_source can be a path (JSON or TXT), an already loaded API payload or a list of PolizaLine,
+    vx_source a path or a list of PolizaLine. date_stamp defaults to the one in the VG file name"""
+    options = options or ReconcileOptions()
+    if isinstance(vg_source, (str, os.PathLike)):
+        date_stamp = date_stamp or extract_poliza_date_from_fname(os.path.basename(vg_source))
+        lines_vg = get_vg_poliza_lines(vg_source)
+    elif isinstance(vg_source, dict):
+        lines_vg = json_to_poliza_lines(vg_source)
+    else:
+        lines_vg = list(vg_source)
+    if isinstance(vx_source, (str, os.PathLike)):
+        lines_vx = get_vx_poliza_lines(vx_source)
+    else:
+        lines_vx = list(vx_source)
+    return ReconcileResult.from_day_result(diff_poliza_day(date_stamp, lines_vg, lines_vx, options))
+
+
+def summarize_day(day_result: DayResult) -> DaySummary:
+    matches, non_matches, _match_pctg = get_match_stats(day_result.matched_lines, day_result.unmatched_lines)
+    accounts = sorted({tgt.account for tgt, _src in day_result.matched_lines + day_result.unmatched_lines})
+    return DaySummary(day_result.date_stamp, accounts, matches, non_matches,
+                      count_unmatched_concepts(day_result.unmatched_lines), dict(day_result.matches_by_acc),
+                      dict(day_result.diffs_by_acc), day_result.sister_swaps)
+
+
+def diff_poliza_day(poliza_date_stamp: str, lines_vg: list[PolizaLine], lines_vx: list[PolizaLine],
+                    options: ReconcileOptions) -> DayResult:
+    """Reconcile the already parsed VG and VX lines of a single day"""
+    lines_vx = tag_no_account_lines(lines_vx)
+    lines_vg = tag_no_account_lines(lines_vg)
+
+    matched_lines, unmatched_lines, odd_amounts_buffer, near_misses = get_matches(
+        lines_vx, lines_vg, options, src_lbl="POLIZA VX", target_lbl="POLIZA VG")
+    _matches, _non_matches, match_pctg = get_match_stats(
+        matched_lines, unmatched_lines)
+
+    matched_by_acc, unmatched_by_acc, _odd_amounts = get_matches_by_account(
+        lines_vg, lines_vx)
+    # If an account is in neither, assume a match
+    matches_by_acc = defaultdict(lambda: 0)
+    diffs_by_acc = dict()
+    diffs_by_acc.update(get_diffs_by_account(matched_by_acc))
+    for tgt, src in matched_by_acc + unmatched_by_acc:
+        if src is None:
+            # No match
+            matches_by_acc[tgt.account] = 1
+        else:
+            # Match
+            matches_by_acc[tgt.account] = 0
+    # Without groups any two accounts with opposite diffs would be paired, so swaps are only looked for
+    # between the accounts of a sister file
+    sister_groups = load_sister_groups(options.sister_file) if options.sister_file else None
+    sister_swaps = miscategorized_sister_accounts(lines_vg, lines_vx, sister_groups) if sister_groups else []
+    return DayResult(poliza_date_stamp, matched_lines, unmatched_lines, odd_amounts_buffer,
+                     matches_by_acc, diffs_by_acc, match_pctg, near_misses, sister_swaps)
+
+
+def format_day_result(day_result: DayResult, vg_poliza_fname: str, vx_poliza_fname: str, fast_tables=False) -> str:
+    current_date_stdout = io.StringIO("")
+    current_date = dt.datetime.strptime(day_result.date_stamp, "%Y%m%d")
+    # Only the NO MATCH table is shown for a day
+    _ok_msg, err_msg = tabulate_results(
+        day_result.matched_lines, day_result.unmatched_lines, day_result.odd_amounts_buffer, headers=TABLE_HEADERS,
+        render_ok=False, fast_tables=fast_tables)
+    print(current_date.strftime("%a %d %b %Y"), file=current_date_stdout)
+    print(f"COMPARING: {vg_poliza_fname} vs. {vx_poliza_fname}", file=current_date_stdout)
+    print(err_msg, file=current_date_stdout)
+    if day_result.near_misses:
+        print(format_near_misses(day_result.near_misses, fast_tables), file=current_date_stdout)
+    for swap in day_result.sister_swaps:
+        print("SISTER SWAP ({}): {} <-> {} {:.2f}".format(
+            swap.type, swap.account_a, swap.account_b, swap.moved_cents / 100), file=current_date_stdout)
+    return current_date_stdout.getvalue()
+
+
+def print_global_stats(day_results: list[DayResult]):
+    print_day_summaries_stats([summarize_day(day_result) for day_result in day_results])
+
+
+def print_day_summaries_stats(day_summaries: list[DaySummary]):
+    if not day_summaries:
+        print("No days selected")
+        return
+    global_matches, global_non_matches = 0, 0
+    for day_summary in day_summaries:
+        global_matches += day_summary.matches
+        global_non_matches += day_summary.non_matches
+
+    global_match_pctg = global_matches / \
+        ((global_matches + global_non_matches) or 1)
+    common_unmatched_concepts = rank_unmatched_concepts(
+        day_summary.unmatched_concepts for day_summary in day_summaries)
+    print("Global match pctg: {:.2f}%".format(global_match_pctg * 100))
+    print("\n\n")
+    print("These concepts were the most unmatched")
+    for common_unmatched_concept, count in common_unmatched_concepts:
+        print(f"{common_unmatched_concept} ({count} misses)")
+
+
+def print_filter_stats():
+    print(VG_LINE_FILTER.format_stats())
+    print(VX_LINE_FILTER.format_stats())
+
+
+def write_dir_reports(day_results: list[DayResult], report_fname=REPORT_FNAME, diff_report_fname=DIFF_REPORT_FNAME):
+    write_day_summaries_reports([summarize_day(day_result) for day_result in day_results], report_fname,
+                                diff_report_fname)
+
+
+def write_day_summaries_reports(day_summaries: list[DaySummary], report_fname=REPORT_FNAME,
+                                diff_report_fname=DIFF_REPORT_FNAME):
+    all_accounts = set()
+    for day_summary in day_summaries:
+        all_accounts.update(day_summary.accounts)
+    # Ensure constant ordering
+    all_accounts = list(sorted(list(all_accounts)))
+    with open(report_fname, "w") as report, open(diff_report_fname, "w") as diffs:
+        report_writer = csv.writer(report)
+        diff_writer = csv.writer(diffs)
+        report_writer.writerow(["Fecha"] + all_accounts)
+        diff_writer.writerow(["Fecha"] + all_accounts)
+        for day_summary in day_summaries:
+            day = dt.datetime.strptime(day_summary.date_stamp, "%Y%m%d").strftime("%d-%m-%Y")
+            # Days without any line don't have an entry in the matches report
+            if day_summary.matches_by_acc:
+                day_results_row = [day] + [day_summary.matches_by_acc.get(account, 0)
+                                           for account in all_accounts]
+                report_writer.writerow(day_results_row)
+        for day_summary in day_summaries:
+            day = dt.datetime.strptime(day_summary.date_stamp, "%Y%m%d").strftime("%d-%m-%Y")
+            day_diffs = [day] + [day_summary.diffs_by_acc.get(account, 0.0) for account in all_accounts]
+            diff_writer.writerow(day_diffs)
+
+
+def get_account_match_tolerances(lines_vg: list[PolizaLine], lines_vx: list[PolizaLine]) -> dict:
+    """Account -> smallest tolerance at which get_matches_by_account reports the account as a match,
+    which is the largest one any of its collapsed lines needs"""
+    lines_vg = tag_no_account_lines(lines_vg)
+    lines_vx = tag_no_account_lines(lines_vx)
+    all_accounts_rules = CollapseRules(
+        {line.account: CollapsedAccount(line.account, line.account) for line in lines_vg + lines_vx})
+    collapsed_vg, _extracted = collapse_lines(lines_vg, all_accounts_rules)
+    collapsed_vx, _extracted = collapse_lines(lines_vx, all_accounts_rules)
+    tolerances = {}
+    for line in collapsed_vx:
+        tolerances[line.account] = max(tolerances.get(line.account, 0.0), get_match_tolerance(line, collapsed_vg))
+    return tolerances
+
+
+def parse_tolerances(value: str) -> list[float]:
+    try:
+        tolerances = sorted({float(tolerance) for tolerance in value.split(",") if tolerance.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid tolerances {value}, expected i.e. 0.5,1,2,5")
+    if not tolerances or tolerances[0] <= 0:
+        raise argparse.ArgumentTypeError(f"Invalid tolerances {value}, they must be greater than 0")
+    return tolerances
+
+
+TOLERANCE_REPORT_FNAME = "REPORTE_TOLERANCIAS_POLIZA.csv"
+SWEEP_HEADERS = ["Tolerancia", "Cuentas match", "Cuentas", "Match pctg"]
+
+
+def sweep_tolerances(days: dict, tolerances: list[float], fast_tables=False, report_fname=TOLERANCE_REPORT_FNAME):
+    """Parse every day once, compute the smallest matching tolerance of each of its accounts and
+    print the account match percentage of the whole range for every tolerance"""
+    day_tolerances = {}
+    for date_stamp, day in days.items():
+        if day.vg_fname and day.vx_fname:
+            day_tolerances[date_stamp] = get_account_match_tolerances(
+                get_vg_poliza_lines(day.vg_fname), get_vx_poliza_lines(day.vx_fname))
+    all_tolerances = sorted(tolerance for account_tolerances in day_tolerances.values()
+                            for tolerance in account_tolerances.values())
+    rows = []
+    for tolerance in tolerances:
+        # An account matches with tolerance if its own is strictly below it
+        matches = bisect.bisect_left(all_tolerances, tolerance)
+        rows.append(["{:.2f}".format(tolerance), matches, len(all_tolerances),
+                     "{:.2f}%".format(matches / (len(all_tolerances) or 1) * 100)])
+    render_table = get_table_renderer(fast_tables)
+    print(render_table(rows, headers=SWEEP_HEADERS))
+
+    with open(report_fname, "w") as report:
+        writer = csv.writer(report)
+        writer.writerow(["Fecha", "Cuenta", "Tolerancia minima"])
+        for date_stamp, account_tolerances in day_tolerances.items():
+            day = dt.datetime.strptime(date_stamp, "%Y%m%d").strftime("%d-%m-%Y")
+            for account, tolerance in sorted(account_tolerances.items()):
+                writer.writerow([day, account, "{:.2f}".format(tolerance)])
+
+
+PolizaDay = namedtuple("PolizaDay", ["date_stamp", "vg_fname", "vx_fname", "vg_mtime", "vx_mtime"])
+
+
+def parse_date_stamp(value: str) -> str:
+    """Accepts YYYYMMDD or YYYY-MM-DD and returns a YYYYMMDD date stamp"""
+    for fmt in ("%Y%m%d", "%Y-%m-%d"):
+        try:
+            return dt.datetime.strptime(value, fmt).strftime("%Y%m%d")
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"Invalid date {value}, expected YYYYMMDD or YYYY-MM-DD")
+
+
+def parse_weekdays(value: str) -> set[int]:
+    weekdays = set()
+    for day in value.lower().split(","):
+        day = day.strip()[:3]
+        if day.isdigit() and 0 <= int(day) < 7:
+            weekdays.add(int(day))
+        elif day in WEEKDAYS:
+            weekdays.add(WEEKDAYS.index(day))
+        else:
+            raise argparse.ArgumentTypeError(f"Invalid weekday {day}, expected mon..sun or 0..6")
+    return weekdays
+
+
+def parse_months(value: str) -> set[int]:
+    months = set()
+    for month in value.split(","):
+        if not month.strip().isdigit() or not 1 <= int(month) <= 12:
+            raise argparse.ArgumentTypeError(f"Invalid month {month}, expected 1..12")
+        months.add(int(month))
+    return months
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Accepts i/N with 1 <= i <= N"""
+    shard_match = re.fullmatch(r"(\d+)/(\d+)", value.strip())
+    if not shard_match or not 1 <= int(shard_match[1]) <= int(shard_match[2]):
+        raise argparse.ArgumentTypeError(f"Invalid shard {value}, expected i/N with 1 <= i <= N")
+    return int(shard_match[1]), int(shard_match[2])
+
+
+def make_day_filter(date_from: str = None, date_to: str = None, weekdays: set = None, months: set = None,
+                    shard: tuple = None):
+    """Build a predicate over YYYYMMDD date stamps. Both ends of the range are inclusive.
+    With shard (i, N), only days whose date ordinal modulo N is i - 1 are kept"""
+    def day_filter(date_stamp: str) -> bool:
+        if date_from and date_stamp < date_from:
+            return False
+        if date_to and date_stamp > date_to:
+            return False
+        if weekdays is not None or months is not None or shard is not None:
+            try:
+                date = dt.datetime.strptime(date_stamp, "%Y%m%d")
+            except ValueError:
+                return False
+            if weekdays is not None and date.weekday() not in weekdays:
+                return False
+            if months is not None and date.month not in months:
+                return False
+            if shard is not None and date.toordinal() % shard[1] != shard[0] - 1:
+                return False
+        return True
+    return day_filter
+
+
+def get_day_filter(args):
+    return make_day_filter(args.date_from, args.date_to, args.weekday, args.month, args.shard)
+
+
+# When a day has more than one VG poliza, the payloads poliza_api writes now win over the plain
+# payloads of older runs, and both over anything else
+VG_SUFFIX_PREFERENCE = (PAYLOAD_SUFFIX, ".json")
+
+
+def _vg_fname_rank(fname: str) -> int:
+    for rank, suffix in enumerate(VG_SUFFIX_PREFERENCE):
+        if fname.endswith(suffix):
+            return rank
+    return len(VG_SUFFIX_PREFERENCE)
+
+
+def index_poliza_dirs(poliza_vg_dir: str, poliza_vauxoo_dir: str, day_filter=None) -> tuple[dict, list]:
+    """Scan both directories once and map each date stamp to its VG and VX polizas.
+    Days that only exist on one side are kept with the missing file set to None.
+    Names are matched before stat is called, so files outside of day_filter are never stat'ed.
+    Returns the day index and the names of undated files in the VG directory"""
+    days = {}
+    undated = []
+    with os.scandir(poliza_vg_dir) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            # Checksum sidecars and in-progress writes of compressed payloads
+            if entry.name.startswith(".") or entry.name.endswith((CHECKSUM_SUFFIX, TMP_SUFFIX)):
+                continue
+            date_match = DATE_STAMP_MATCHER.search(entry.name)
+            if not date_match:
+                undated.append(entry.name)
+                continue
+            date_stamp = date_match["date"]
+            if (day_filter and not day_filter(date_stamp)) or not entry.is_file():
+                continue
+            if date_stamp in days:
+                covered_fname = days[date_stamp].vg_fname
+                if _vg_fname_rank(entry.name) >= _vg_fname_rank(covered_fname):
+                    log.warning("Ignoring %s, %s already covers %s", entry.path, covered_fname, date_stamp)
+                    continue
+                log.warning("Ignoring %s, %s covers %s", covered_fname, entry.path, date_stamp)
+            days[date_stamp] = PolizaDay(date_stamp, entry.path, None, entry.stat().st_mtime_ns, None)
+    with os.scandir(poliza_vauxoo_dir) as entries:
+        for entry in entries:
+            fname_match = VX_FNAME_MATCHER.match(entry.name)
+            if not fname_match:
+                continue
+            date_stamp = fname_match["date"]
+            if (day_filter and not day_filter(date_stamp)) or not entry.is_file():
+                continue
+            day = days.get(date_stamp) or PolizaDay(date_stamp, None, None, None, None)
+            days[date_stamp] = day._replace(vx_fname=entry.path, vx_mtime=entry.stat().st_mtime_ns)
+    return dict(sorted(days.items())), undated
+
+
+def print_poliza_days(days: dict):
+    for day in days.values():
+        print(f"{day.date_stamp}  VG: {day.vg_fname or 'MISSING'}  VX: {day.vx_fname or 'MISSING'}")
+    one_sided = sum(1 for day in days.values() if not (day.vg_fname and day.vx_fname))
+    print(f"{len(days)} days, {one_sided} with only one side")
+
+
+def watch_dirs(poliza_vg_dir: str, poliza_vauxoo_dir: str, args, options: ReconcileOptions):
+    """Keep every day reconciled in memory and only recompute the days whose
+    VG or VX poliza was created or modified since the last poll"""
+    day_filter = get_day_filter(args)
+    parsed_lines = {}  # fname -> (mtime, lines)
+    day_results = {}  # date stamp -> DayResult
+    indexed_days = {}
+    while True:
+        days, _undated = index_poliza_dirs(poliza_vg_dir, poliza_vauxoo_dir, day_filter)
+        changed_days = [day for date_stamp, day in days.items() if indexed_days.get(date_stamp) != day]
+        removed_days = [date_stamp for date_stamp in indexed_days if date_stamp not in days]
+        indexed_days = days
+        refreshed = False
+        for date_stamp in removed_days:
+            refreshed |= day_results.pop(date_stamp, None) is not None
+        live_fnames = {fname for day in days.values() for fname in (day.vg_fname, day.vx_fname)}
+        for fname in list(parsed_lines):
+            if fname not in live_fnames:
+                del parsed_lines[fname]
+
+        for day in changed_days:
+            if not day.vg_fname or not day.vx_fname:
+                refreshed |= day_results.pop(day.date_stamp, None) is not None
+                continue
+            try:
+                lines_vg = _get_cached_lines(parsed_lines, day.vg_fname, day.vg_mtime, get_vg_poliza_lines)
+                lines_vx = _get_cached_lines(parsed_lines, day.vx_fname, day.vx_mtime, get_vx_poliza_lines)
+            except (OSError, EOFError, ValueError, StopIteration, AssertionError) as e:
+                # File is probably still being written, retry on next poll
+                log.warning("Could not read poliza for %s: %s", day.date_stamp, e)
+                parsed_lines.pop(day.vg_fname, None)
+                parsed_lines.pop(day.vx_fname, None)
+                indexed_days.pop(day.date_stamp)
+                continue
+            day_result = diff_poliza_day(day.date_stamp, lines_vg, lines_vx, options)
+            day_results[day.date_stamp] = day_result
+            refreshed = True
+            if day_result.match_pctg < 1:
+                print(format_day_result(day_result, day.vg_fname, day.vx_fname, args.fast_tables))
+            else:
+                print(f"MATCH: {day.date_stamp}")
+
+        if refreshed and day_results:
+            sorted_results = [day_results[day] for day in sorted(day_results)]
+            write_dir_reports(sorted_results)
+            print_global_stats(sorted_results)
+            print_sister_swaps(sorted_results, args.fast_tables)
+            sys.stdout.flush()
+        time.sleep(args.watch_interval)
+
+
+def _get_cached_lines(parsed_lines: dict, fname: str, mtime: int, parse_fn) -> list[PolizaLine]:
+    cached = parsed_lines.get(fname)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, parse_fn(fname))
+        parsed_lines[fname] = cached
+    return cached[1]
+
+
 def get_matches_by_account(lines_src, lines_target):
     all_accounts = set()
     matched_lines = []
@@ -299,20 +882,20 @@ def get_matches_by_account(lines_src, lines_target):
     for line in lines_src + lines_target:
         all_accounts.add(line.account)
 
-    for account in all_accounts:
-        lines_src, _extracted, _credit, _debit, = collapse_account(
-            lines_src, account, descr=account)
-        lines_target, _extracted, _credit, _debit, = collapse_account(
-            lines_target, account, descr=account)
+    all_accounts_rules = CollapseRules(
+        {account: CollapsedAccount(account, account) for account in all_accounts})
+    lines_src, _extracted = collapse_lines(lines_src, all_accounts_rules)
+    lines_target, _extracted = collapse_lines(lines_target, all_accounts_rules)
 
     for line_target in lines_target:
-        if matched_line := line_has_match(line_target, lines_src, strict=False, show_close_matches=False):
+        if matched_line := line_has_match(line_target, lines_src, strict=False):
             matched_lines.append((line_target, matched_line))
         else:
             unmatched_lines.append((line_target, None))
     return matched_lines, unmatched_lines, _odd_amounts_buffer
 
 def get_diffs_by_account(matched_lines):
+    """VX account -> VX - VG, for the (VX line, VG line) pairs of get_matches_by_account"""
     diffs_by_acc = dict()
     for line, target in matched_lines:
         diff =  float(line.sign + line.amount) - float(target.sign + target.amount)
@@ -320,26 +903,98 @@ def get_diffs_by_account(matched_lines):
     return diffs_by_acc
 
 
-def tabulate_results(matched_lines, unmatched_lines, odd_amounts_buffer, headers) -> tuple:
+def tabulate_results(matched_lines, unmatched_lines, odd_amounts_buffer, headers, render_ok=True, render_err=True,
+                     fast_tables=False) -> tuple:
+    """Render the MATCH (ok) and NO MATCH (err) tables. Tables that won't be printed can be skipped
+    with render_ok/render_err, in which case an empty string is returned in their place"""
+    render_table = get_table_renderer(fast_tables)
     out_str = io.StringIO("")
     err_str = io.StringIO("")
-    matched_table = ([
+    if render_ok:
+        print(render_table(get_matched_table(matched_lines), headers=headers), file=out_str)
+    if render_err:
+        print(render_table(get_unmatched_table(unmatched_lines), headers=headers), file=err_str)
+        for odd_amount in odd_amounts_buffer:
+            print(format_odd_amount(odd_amount), file=err_str)
+        matches, non_matches, match_pctg = get_match_stats(
+            matched_lines, unmatched_lines)
+        print("Summary:\nMatching concepts: {}\nNon matching: {}\nMatching pctg: {:.2f}%".format(
+            matches, non_matches, match_pctg * 100), file=err_str)
+    return out_str.getvalue(), err_str.getvalue()
+
+
+def get_table_renderer(fast_tables=False):
+    if fast_tables:
+        return render_fixed_width_table
+    # tabulate is only imported once a table is actually rendered
+    import tabulate
+    return tabulate.tabulate
+
+
+def get_matched_table(matched_lines) -> list[list[str]]:
+    return ([
         ["MATCH", tgt.account, tgt.concept, format_amount((tgt.sign, tgt.amount, tgt.type)), format_amount(
             (src.sign, src.amount, src.type)), src.account, src.concept]
         for tgt, src in matched_lines])
-    unmatched_table = ([
+
+
+def get_unmatched_table(unmatched_lines) -> list[list[str]]:
+    return ([
         ["NO MATCH", tgt.account, tgt.concept, format_amount((tgt.sign, tgt.amount, tgt.type)), format_amount(
             (possible_tgt.sign, possible_tgt.amount, possible_tgt.type)) if possible_tgt else "", possible_tgt.concept if possible_tgt else "", possible_tgt.account if possible_tgt else ""]
         for tgt, possible_tgt in unmatched_lines])
-    print(tabulate.tabulate(matched_table, headers=headers), file=out_str)
-    print(tabulate.tabulate(unmatched_table, headers=headers), file=err_str)
-    for msg in odd_amounts_buffer:
-        print(msg, file=err_str)
-    matches, non_matches, match_pctg = get_match_stats(
-        matched_lines, unmatched_lines)
-    print("Summary:\nMatching concepts: {}\nNon matching: {}\nMatching pctg: {:.2f}%".format(
-        matches, non_matches, match_pctg * 100), file=err_str)
-    return out_str.getvalue(), err_str.getvalue()
+
+
+# Cell types from least to most generic, as tabulate deduces them. Empty cells don't change a column's type
+_CELL_TYPE_RANK = {None: 0, bool: 1, int: 2, float: 3, str: 4}
+
+
+def _cell_type(value: str):
+    if not value:
+        return None
+    if value in ("True", "False"):
+        return bool
+    for _type in (int, float):
+        try:
+            _type(value)
+            return _type
+        except ValueError:
+            pass
+    return str
+
+
+def _afterpoint(value: str) -> int:
+    """Characters after the decimal point of a number, -1 for integers and anything else"""
+    if _cell_type(value) is not float:
+        return -1
+    pos = value.rfind(".")
+    pos = value.lower().rfind("e") if pos < 0 else pos
+    return len(value) - pos - 1 if pos >= 0 else -1
+
+
+def render_fixed_width_table(rows: list[list[str]], headers: list[str]) -> str:
+    """Single pass fixed-width renderer that mimics tabulate's "simple" format with its default floatfmt="g"
+    and numalign="decimal" for the poliza tables: float columns are formatted with "g", numeric columns are
+    right aligned on their decimal point and everything else is left aligned"""
+    rows = [[str(cell).strip() for cell in row] for row in rows]
+    columns = []
+    for i, header in enumerate(headers):
+        cells = [row[i] for row in rows]
+        column_type = max((_cell_type(cell) for cell in cells), key=_CELL_TYPE_RANK.get, default=None)
+        numeric = column_type in (int, float)
+        if column_type is float:
+            cells = [format(float(cell), "g") if _cell_type(cell) in (int, float) else cell for cell in cells]
+        if numeric:
+            decimals = [_afterpoint(cell) for cell in cells]
+            max_decimals = max(decimals, default=-1)
+            cells = [cell + " " * (max_decimals - cell_decimals) for cell, cell_decimals in zip(cells, decimals)]
+        width = max([len(header) + 2] + [len(cell) for cell in cells])
+        align = str.rjust if numeric else str.ljust
+        columns.append([align(header, width)] + [align(cell, width) for cell in cells])
+
+    lines = ["  ".join(cells).rstrip() for cells in zip(*columns)] if columns else [""] * (len(rows) + 1)
+    lines.insert(1, "  ".join("-" * len(column[0]) for column in columns))
+    return "\n".join(lines)
 
 
 def get_match_stats(matched_lines, unmatched_lines) -> tuple:
@@ -350,29 +1005,31 @@ def get_match_stats(matched_lines, unmatched_lines) -> tuple:
     return matches, non_matches, match_pctg
 
 
-def add_to_odd_amounts(odd_lines: list[PolizaLine], odd_amounts_acc_list: list[str], source: str, target: str):
+def add_to_odd_amounts(odd_lines: list[PolizaLine], odd_amounts_acc_list: list[OddAmount], source: str, target: str):
     for line in odd_lines:
-        msg = f"WARNING: {line.concept}  {format_amount((line.sign, line.amount, line.type))} exists in {source} but not in {target}. Removing it makes accounts {line.account} match."
-        odd_amounts_acc_list.append(msg)
+        odd_amounts_acc_list.append(OddAmount(line, source, target))
+
+
+def format_odd_amount(odd_amount: OddAmount) -> str:
+    line, source, target = odd_amount
+    return f"WARNING: {line.concept}  {format_amount((line.sign, line.amount, line.type))} exists in {source} but not in {target}. Removing it makes accounts {line.account} match."
+
 
+def accounts_match(account: str, other_account: str) -> bool:
+    """Accounts are the same if one contains the other, i.e. a VG account and its zero padded VX account"""
+    account, other_account = account.strip(), other_account.strip()
+    return account in other_account or other_account in account
 
-def line_has_match(line: PolizaLine, domain: list, tolerance=2.0, tolerance_upper_bound=5.0, strict=False, show_close_matches=False) -> PolizaLine:
+
+def line_has_match(line: PolizaLine, domain: list, tolerance=2.0, strict=False) -> PolizaLine:
     line_amount = float(line.amount)
     line_type = line.type
-    line_sign = line.sign
     for target_line in domain:
-        target_amount = float(target_line.amount)
-        target_type = target_line.type
-        target_sign = target_line.sign
-        if (target_line.account.strip() in line.account.strip()
-                or line.account.strip() in target_line.account.strip()):
-
-            if not abs(line_amount - target_amount) < tolerance and line_type == target_type:
+        if accounts_match(line.account, target_line.account):
+            target_amount = float(target_line.amount)
+            if not abs(line_amount - target_amount) < tolerance and line_type == target_line.type:
                 return False
             return target_line
-        elif (diff := abs(line_amount - target_amount)) < tolerance_upper_bound and line_type == target_type and show_close_matches:
-            log.warning("Concepts %s, %s close to matching by $%s",
-                        target_line.concept, line.concept, diff)
     # If no line was found, maybe the amount is very close to zero, so we can consider it a match within the tolerance level
     if abs(line_amount) < tolerance:
         new_line = PolizaLine(line.account, line.concept, line.sign, "0.0", line.type) 
@@ -380,6 +1037,18 @@ def line_has_match(line: PolizaLine, domain: list, tolerance=2.0, tolerance_uppe
     return False
 
 
+def get_match_tolerance(line: PolizaLine, domain: list) -> float:
+    """Smallest tolerance line_has_match needs to match line against domain: it matches with any
+    tolerance above the returned amount difference"""
+    line_amount = float(line.amount)
+    for target_line in domain:
+        if accounts_match(line.account, target_line.account):
+            if line.type != target_line.type:
+                return 0.0
+            return abs(line_amount - float(target_line.amount))
+    return abs(line_amount)
+
+
 def get_dummy_line() -> PolizaLine:
     return PolizaLine("", "", "", "", "")
 
@@ -393,19 +1062,6 @@ def process_vauxoo_line(csv: list) -> PolizaLine:
     return PolizaLine(account + "0" * padding, concept, sign, amount, _type)
 
 
-def remove_unsupported_vg_lines(lines: list[PolizaLine]) -> list[PolizaLine]:
-    lines = filter(lambda l: "spa" not in l.concept.lower(), lines)
-    lines = filter(lambda l: "masaje" not in l.concept.lower(), lines)
-    lines = filter(lambda l: "facial" not in l.concept.lower(), lines)
-    lines = filter(lambda l: "boutique" not in l.concept.lower(), lines)
-    lines = filter(lambda l: "belleza" not in l.concept.lower(), lines)
-    return list(lines)
-
-
-def remove_empty_lines(lines: list[PolizaLine]) -> list[PolizaLine]:
-    return list(filter(lambda line: line.amount != "0.00", lines))
-
-
 def tag_no_account_lines(lines: list[PolizaLine]) -> list[PolizaLine]:
     ret = list(map(lambda l: l if l.account !=
                "" else PolizaLine("SIN CUENTA", *l[1:]), lines))
@@ -415,6 +1071,30 @@ def tag_no_account_lines(lines: list[PolizaLine]) -> list[PolizaLine]:
 def collapse_account(lines: list[PolizaLine], account: str, descr: str) -> (list[PolizaLine], list[PolizaLine], PolizaLine, PolizaLine):
     extracted_lines = list(filter(lambda l: l.account == account, lines))
     all_other_lines = list(filter(lambda l: l.account != account, lines))
+    new_line_debit, new_line_credit = append_collapsed_lines(
+        all_other_lines, account, descr, extracted_lines)
+    return all_other_lines, extracted_lines, new_line_credit, new_line_debit
+
+
+def collapse_lines(lines: list[PolizaLine], rules: CollapseRules) -> tuple[list[PolizaLine], dict]:
+    """Apply every collapse rule in a single pass over lines. Returns the lines with the collapsed
+    accounts replaced by their debit/credit totals, and the extracted lines by account"""
+    extracted_by_account = {account: [] for account in rules.by_account}
+    all_other_lines = []
+    for line in lines:
+        extracted = extracted_by_account.get(line.account)
+        if extracted is None:
+            all_other_lines.append(line)
+        else:
+            extracted.append(line)
+    for account, rule in rules.by_account.items():
+        append_collapsed_lines(all_other_lines, account, rule.description, extracted_by_account[account])
+    return all_other_lines, extracted_by_account
+
+
+def append_collapsed_lines(lines: list[PolizaLine], account: str, descr: str, extracted_lines: list[PolizaLine]) -> tuple:
+    """Sum the debit and credit amounts of extracted_lines into one line each and append to lines
+    the ones that don't add up to zero. Returns the (debit, credit) lines"""
     amount_debit = sum(float(l.sign + l.amount)
                        for l in filter(lambda l: l.type == "c", extracted_lines))
     amount_credit = sum(float(l.sign + l.amount)
@@ -428,10 +1108,10 @@ def collapse_account(lines: list[PolizaLine], account: str, descr: str) -> (list
     new_line_credit = PolizaLine(
         account, descr, credit_sign, credit_amount, credit_type)
     if amount_debit:
-        all_other_lines.append(new_line_debit)
+        lines.append(new_line_debit)
     if amount_credit:
-        all_other_lines.append(new_line_credit)
-    return all_other_lines, extracted_lines, new_line_credit, new_line_debit
+        lines.append(new_line_credit)
+    return new_line_debit, new_line_credit
 
 
 def concept_into_words(concept: str) -> list[str]:
@@ -460,12 +1140,24 @@ def get_possible_target(line: PolizaLine, candidates: list[PolizaLine]) -> Poliz
 
 def find_common_unmatched_concepts(mismatched_lines_list: list[list[PolizaLine]]) -> list:
     # Given a list of lists of candidate lines, find concepts that are common several polizas
-    target_len = len(mismatched_lines_list)
+    return rank_unmatched_concepts(count_unmatched_concepts(candidate_list) for candidate_list in mismatched_lines_list)
+
+
+def count_unmatched_concepts(unmatched_lines: list[tuple]) -> dict:
+    """"(account) concept" -> misses, in order of first appearance"""
+    concept_count = defaultdict(lambda: 0)
+    for line, _possible_tgt in unmatched_lines:
+        concept = f"({line.account}) {line.concept}"
+        concept_count[concept] += 1
+    return dict(concept_count)
+
+
+def rank_unmatched_concepts(concept_counts) -> list:
+    """Add up per poliza concept counts and sort them by misses. Ties keep their order of first appearance"""
     concept_count = defaultdict(lambda: 0)
-    for candidate_list in mismatched_lines_list:
-        for line, _possible_tgt in candidate_list:
-            concept = f"({line.account}) {line.concept}"
-            concept_count[concept] += 1
+    for counts in concept_counts:
+        for concept, count in counts.items():
+            concept_count[concept] += count
     common_concepts = dict(filter(lambda c: c[1] != 0, sorted(
         concept_count.items(), key=lambda c: c[1], reverse=True)))
     return list(common_concepts.items())
@@ -489,19 +1181,226 @@ def get_odd_amounts_out(lines: list[PolizaLine], target_amount: float, tolerance
     return []
 
 
-def miscategorized_sister_accounts(sister_account_lines: tuple, target_sister_account_lines: tuple) -> bool:
+def load_sister_groups(fname: str) -> dict:
+    """Parse a sister accounts file ('account,group' rows) into account -> group, or None if it doesn't exist.
+    Cached by path and mtime"""
+    cache_key = os.path.abspath(fname)
+    try:
+        mtime = os.stat(fname).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    cached = _sister_groups_cache.get(cache_key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    groups = None
+    if mtime is None:
+        log.warning("Sister accounts file %s not found, no sister swaps will be reported", fname)
+    else:
+        groups = {}
+        with open(fname, "r") as file:
+            for row_num, row in enumerate(csv.reader(file), start=1):
+                if not row or row[0].startswith("#"):
+                    continue
+                if len(row) != 2:
+                    log.warning("%s:%d: expected 'account,group', got %s", fname, row_num, row)
+                    continue
+                groups[row[0]] = row[1]
+    _sister_groups_cache[cache_key] = (mtime, groups)
+    return groups
+
+
+def miscategorized_sister_accounts(lines_vg: list[PolizaLine], lines_vx: list[PolizaLine], sister_groups: dict = None,
+                                   tolerance=SISTER_SWAP_TOLERANCE) -> list[SisterSwap]:
     """It has occured that two 'sister' accounts (i.e DELI BEBIDAS & DELI ALIMENTOS) have products that
-    are badly categorized. so if each category has target amounts B1 and B2, its corresponding 
+    are badly categorized. so if each category has target amounts B1 and B2, its corresponding
     actual amounts are A1 + X.XX and A2 - X.XX
-    This function detects that special case"""
-    a1_lines, a2_lines = sister_account_lines
-    b3_lines, b4_lines = target_sister_account_lines
-    my_amount = sum(float(a1.amount) for a1 in a1_lines) + \
-        sum(float(a2.amount) for a2 in a2_lines)
-    target_amount = sum(float(b1.amount) for b1 in b1_lines) + \
-        sum(float(b2.amount) for b2 in b2_lines)
-    return my_amount == target_amount
-
+    This function detects that special case: account diffs (VX - VG, by type) are bucketed by their cents,
+    so the account whose diff cancels another one is looked up in the buckets around its negated diff.
+    With sister_groups, only accounts of the same group are paired"""
+    diffs = defaultdict(int)
+    for line in lines_vx:
+        diffs[(line.account, line.type)] += amount_cents(line)
+    for line in lines_vg:
+        diffs[(line.account, line.type)] -= amount_cents(line)
+    tolerance_cents = round(tolerance * 100)
+    # Accounts that already match don't need a sister. Lines without an account are tagged differently
+    # on each side (SIN CUENTA on VG, zero padded on VX), those aren't sister accounts either
+    mismatched = [(key, cents) for key, cents in diffs.items()
+                  if abs(cents) >= tolerance_cents and key[0] != "SIN CUENTA" and key[0].strip("0")]
+    if sister_groups is not None:
+        mismatched = [(key, cents) for key, cents in mismatched if key[0] in sister_groups]
+    buckets = defaultdict(list)
+    for key, cents in mismatched:
+        buckets[(key[1], cents // tolerance_cents)].append((key[0], cents))
+
+    swaps = []
+    paired = set()
+    for (account, _type), cents in sorted(mismatched, key=lambda t: (-abs(t[1]), t[0])):
+        if (account, _type) in paired:
+            continue
+        wanted = -cents
+        best = None
+        # A diff strictly within tolerance of wanted can only be in its bucket or the adjacent ones
+        for bucket in range(wanted // tolerance_cents - 1, wanted // tolerance_cents + 2):
+            for other_account, other_cents in buckets.get((_type, bucket), ()):
+                residual = cents + other_cents
+                if (other_account == account or (other_account, _type) in paired
+                        or abs(residual) >= tolerance_cents):
+                    continue
+                if sister_groups is not None and sister_groups[other_account] != sister_groups[account]:
+                    continue
+                if best is None or (abs(residual), other_account) < (abs(best[1]), best[0]):
+                    best = (other_account, residual)
+        if best:
+            other_account, residual = best
+            paired.update({(account, _type), (other_account, _type)})
+            account_a, account_b = sorted((account, other_account))
+            swaps.append(SisterSwap(_type, account_a, account_b, diffs[(account_a, _type)], residual))
+    return swaps
+
+
+SISTER_SWAP_HEADERS = ["Tipo", "Cuenta A", "Cuenta B", "Dias", "Total movido", "Primer dia", "Ultimo dia"]
+
+
+def print_sister_swaps(day_results: list[DayResult], fast_tables=False):
+    """Rank the sister account pairs found over the whole range by the number of days they appear in"""
+    recurring = {}
+    for day_result in day_results:
+        for swap in day_result.sister_swaps:
+            key = (swap.type, swap.account_a, swap.account_b)
+            days, moved_cents, first_day, _last_day = recurring.get(key, (0, 0, day_result.date_stamp, None))
+            recurring[key] = (days + 1, moved_cents + abs(swap.moved_cents), first_day, day_result.date_stamp)
+    if not recurring:
+        return
+    rows = [[_type, account_a, account_b, days, "{:.2f}".format(moved_cents / 100), first_day, last_day]
+            for (_type, account_a, account_b), (days, moved_cents, first_day, last_day)
+            in sorted(recurring.items(), key=lambda item: (-item[1][0], -item[1][1], item[0]))]
+    render_table = get_table_renderer(fast_tables)
+    print("These sister accounts swapped amounts")
+    print(render_table(rows, headers=SISTER_SWAP_HEADERS))
+
+
+def get_unused_vx_lines(day_result: DayResult, lines_vx: list[PolizaLine], options: ReconcileOptions) -> list[PolizaLine]:
+    """VX lines of a day, collapsed the same way get_matches did, that no VG line was matched to"""
+    lines_vx = tag_no_account_lines(lines_vx)
+    if options.collapse_accounts:
+        lines_vx, _extracted = collapse_lines(lines_vx, load_collapse_rules(options.collapse_file))
+    used = Counter(vx for _vg, vx in day_result.matched_lines)
+    unused = []
+    for line in lines_vx:
+        if used[line]:
+            used[line] -= 1
+        else:
+            unused.append(line)
+    return unused
+
+
+def _shift_key(line: PolizaLine) -> tuple:
+    return line.account, line.type, amount_cents(line)
+
+
+class ShiftWindow:
+    """Unmatched VG lines and unused VX lines of the last `days` days, indexed by account, type and
+    cents. Days are added in date order and each line is indexed and removed at most once, so a
+    whole range is paired in linear time holding only the lines of the window"""
+
+    def __init__(self, days: int):
+        self.days = days
+        # (account, type, cents) -> deque of (date ordinal, date stamp, line), oldest first
+        self.vg_index = defaultdict(deque)
+        self.vx_index = defaultdict(deque)
+        # (date ordinal, index, keys added that day), to drop the days that leave the window
+        self.indexed_days = deque()
+
+    def add_day(self, day_result: DayResult, lines_vx: list[PolizaLine], options: ReconcileOptions) -> list[ShiftedMatch]:
+        """Pair the day's leftover lines with the ones of previous days, nearest day first, and keep the
+        rest for the days that follow"""
+        date_stamp = day_result.date_stamp
+        ordinal = dt.datetime.strptime(date_stamp, "%Y%m%d").toordinal()
+        self._evict(ordinal - self.days)
+        shifted = []
+        leftover_vg = []
+        for vg, _possible_vx in day_result.unmatched_lines:
+            if entry := self._pop_nearest(self.vx_index, _shift_key(vg)):
+                vx_ordinal, vx_date_stamp, vx = entry
+                shifted.append(ShiftedMatch(date_stamp, vx_date_stamp, vx_ordinal - ordinal, vg, vx))
+            else:
+                leftover_vg.append(vg)
+        leftover_vx = []
+        for vx in get_unused_vx_lines(day_result, lines_vx, options):
+            if entry := self._pop_nearest(self.vg_index, _shift_key(vx)):
+                vg_ordinal, vg_date_stamp, vg = entry
+                shifted.append(ShiftedMatch(vg_date_stamp, date_stamp, ordinal - vg_ordinal, vg, vx))
+            else:
+                leftover_vx.append(vx)
+        for index, lines in ((self.vg_index, leftover_vg), (self.vx_index, leftover_vx)):
+            keys = []
+            for line in lines:
+                key = _shift_key(line)
+                index[key].append((ordinal, date_stamp, line))
+                keys.append(key)
+            self.indexed_days.append((ordinal, index, keys))
+        return shifted
+
+    def _pop_nearest(self, index: dict, key: tuple):
+        entries = index.get(key)
+        if not entries:
+            return None
+        entry = entries.pop()
+        if not entries:
+            del index[key]
+        return entry
+
+    def _evict(self, min_ordinal: int):
+        while self.indexed_days and self.indexed_days[0][0] < min_ordinal:
+            _ordinal, index, keys = self.indexed_days.popleft()
+            for key in keys:
+                entries = index.get(key)
+                while entries and entries[0][0] < min_ordinal:
+                    entries.popleft()
+                if entries is not None and not entries:
+                    del index[key]
+
+
+def apply_shifted_match(day_summary: DaySummary, shifted: ShiftedMatch) -> DaySummary:
+    """Count the VG line of a shifted match as a match of its day instead of as an unmatched concept"""
+    unmatched_concepts = dict(day_summary.unmatched_concepts)
+    concept = f"({shifted.vg_line.account}) {shifted.vg_line.concept}"
+    unmatched_concepts[concept] -= 1
+    if not unmatched_concepts[concept]:
+        del unmatched_concepts[concept]
+    return day_summary._replace(matches=day_summary.matches + 1, non_matches=day_summary.non_matches - 1,
+                                unmatched_concepts=unmatched_concepts)
+
+
+def format_shifted_match(shifted: ShiftedMatch) -> str:
+    vg = shifted.vg_line
+    return "SHIFTED MATCH ({:+d} days): ({}) {} {} VG {} VX {}".format(
+        shifted.offset, vg.account, vg.concept, format_amount((vg.sign, vg.amount, vg.type)),
+        shifted.vg_date_stamp, shifted.vx_date_stamp)
+
+
+SHIFTED_MATCH_HEADERS = ["Cuenta", "Desfase", "Lineas", "Total", "Primer dia", "Ultimo dia"]
+
+
+def add_shifted_match_stats(shifted_stats: dict, shifted: ShiftedMatch):
+    """Add up shifted matches by account and day offset, as (lines, cents, first day, last day)"""
+    key = (shifted.vg_line.account, shifted.offset)
+    count, cents, first_day, last_day = shifted_stats.get(key, (0, 0, shifted.vg_date_stamp, shifted.vg_date_stamp))
+    shifted_stats[key] = (count + 1, cents + amount_cents(shifted.vg_line), min(first_day, shifted.vg_date_stamp),
+                          max(last_day, shifted.vg_date_stamp))
+
+
+def print_shifted_matches(shifted_stats: dict, window: int, fast_tables=False):
+    """Shifted matches by account and day offset, most frequent first"""
+    print(f"{sum(stats[0] for stats in shifted_stats.values())} lines matched up to {window} days apart")
+    if not shifted_stats:
+        return
+    rows = [[account, "{:+d}".format(offset), count, "{:.2f}".format(cents / 100), first_day, last_day]
+            for (account, offset), (count, cents, first_day, last_day)
+            in sorted(shifted_stats.items(), key=lambda item: (-item[1][0], item[0]))]
+    render_table = get_table_renderer(fast_tables)
+    print(render_table(rows, headers=SHIFTED_MATCH_HEADERS))
 
 if __name__ == "__main__":
     main(sys.argv)
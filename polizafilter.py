@@ -0,0 +1,55 @@
+"""
+Declarative filters for poliza lines. Every rule of a LineFilterSpec is compiled into a single
+predicate that is evaluated once per line while the poliza is being parsed
+"""
+import re
+from collections import namedtuple, Counter
+from poliza2csv import EXCLUDED_CONCEPTS
+
+# Concepts VG includes on its poliza but we don't implement (matched case insensitive, anywhere in the concept)
+UNSUPPORTED_VG_CONCEPTS = ("spa", "masaje", "facial", "boutique", "belleza")
+
+EMPTY_AMOUNT = "0.00"
+
+LineFilterSpec = namedtuple("LineFilterSpec", ["excluded_concepts", "excluded_substrings", "skip_empty_amounts"])
+
+
+class LineFilter:
+    """Compiled LineFilterSpec. Calling it with a concept and amount returns True if the line is kept.
+    Rejected lines are counted in stats under the first rule that rejected them"""
+
+    def __init__(self, name: str, spec: LineFilterSpec):
+        self.name = name
+        self.spec = spec
+        self.excluded_concepts = frozenset(spec.excluded_concepts)
+        self.substring_matcher = None
+        if spec.excluded_substrings:
+            # A single alternation is scanned once per concept instead of once per substring
+            self.substring_matcher = re.compile(
+                "|".join(re.escape(substring.lower()) for substring in spec.excluded_substrings))
+        self.skip_empty_amounts = spec.skip_empty_amounts
+        self.stats = Counter()
+
+    def __call__(self, concept: str, amount: str = None) -> bool:
+        if concept in self.excluded_concepts:
+            self.stats["excluded concept"] += 1
+            return False
+        if self.substring_matcher and (substring_match := self.substring_matcher.search(concept.lower())):
+            self.stats[f"contains '{substring_match.group(0)}'"] += 1
+            return False
+        if self.skip_empty_amounts and amount == EMPTY_AMOUNT:
+            self.stats["empty amount"] += 1
+            return False
+        self.stats["kept"] += 1
+        return True
+
+    def format_stats(self) -> str:
+        lines = [f"{self.name} filter:"]
+        for rule, count in self.stats.most_common():
+            lines.append(f"  {rule}: {count}")
+        return "\n".join(lines)
+
+
+API_LINE_FILTER = LineFilter("API", LineFilterSpec(EXCLUDED_CONCEPTS, (), False))
+VG_LINE_FILTER = LineFilter("VG", LineFilterSpec(EXCLUDED_CONCEPTS, UNSUPPORTED_VG_CONCEPTS, False))
+VX_LINE_FILTER = LineFilter("VX", LineFilterSpec(EXCLUDED_CONCEPTS, (), True))
@@ -0,0 +1,197 @@
+#!/bin/python3
+"""
+Incremental per-account rollup of VG vs VX polizas by day, week, month and year.
+
+Per day account totals are materialized in a state file together with the totals of every
+parent period. When a day changes, its old totals are subtracted from its parent periods and the
+new ones added, so reconciling a month or a year never re-reads the days that didn't change
+"""
+import sys
+import os
+import csv
+import json
+import argparse
+import datetime as dt
+from collections import defaultdict
+from poliza2csv import PolizaLine, ACCOUNT_LEN
+from polizadiff import (index_poliza_dirs, get_vg_poliza_lines, get_vx_poliza_lines, tag_no_account_lines,
+                        parse_date_stamp)
+
+ROLLUP_STATE_FNAME = "ROLLUP_POLIZA.json"
+ROLLUP_REPORT_FNAME = "REPORTE_ROLLUP_POLIZA.csv"
+# States of another version have their totals under other keys, and are rebuilt from scratch
+ROLLUP_STATE_VERSION = 2
+
+PERIODS = ["day", "week", "month", "year"]
+
+# line_has_match default for a single day, scaled by the number of days in a period
+DAY_TOLERANCE = 2.0
+
+ROLLUP_HEADERS = ["Periodo", "Cuenta", "Tipo", "VG", "VX", "Diff", "STATUS"]
+
+
+def get_period_keys(date_stamp: str) -> dict:
+    date = dt.datetime.strptime(date_stamp, "%Y%m%d")
+    return {
+        "day": date_stamp,
+        "week": date.strftime("%G-W%V"),
+        "month": date.strftime("%Y-%m"),
+        "year": date.strftime("%Y"),
+    }
+
+
+def line_cents(line: PolizaLine) -> int:
+    return round(float(line.sign + line.amount) * 100)
+
+
+def normalize_account(account: str) -> str:
+    """VX accounts are zero padded to ACCOUNT_LEN when read, and line_has_match pairs them with the VG
+    account they contain. Padding VG accounts the same way keys both under the same account"""
+    return account.ljust(ACCOUNT_LEN, "0") if account.isdigit() else account
+
+
+def get_day_totals(lines_vg: list[PolizaLine], lines_vx: list[PolizaLine]) -> dict:
+    """Signed totals in cents by "account:type", as [vg, vx]"""
+    totals = defaultdict(lambda: [0, 0])
+    for side, lines in enumerate((lines_vg, lines_vx)):
+        for line in tag_no_account_lines(lines):
+            totals[f"{normalize_account(line.account)}:{line.type}"][side] += line_cents(line)
+    return dict(totals)
+
+
+class PolizaRollup:
+    """Materialized VG/VX totals for every day and every week/month/year that contains them"""
+
+    def __init__(self, state: dict = None):
+        if state and state.get("version") != ROLLUP_STATE_VERSION:
+            print(f"Rollup state version {state.get('version')} is outdated, rebuilding it")
+            state = None
+        state = state or {}
+        self.days = state.get("days", {})
+        self.periods = state.get("periods", {period: {} for period in PERIODS if period != "day"})
+
+    @classmethod
+    def load(cls, fname: str):
+        if not os.path.exists(fname):
+            return cls()
+        with open(fname, "r") as state_file:
+            return cls(json.load(state_file))
+
+    def save(self, fname: str):
+        tmp_fname = fname + ".tmp"
+        with open(tmp_fname, "w") as state_file:
+            json.dump({"version": ROLLUP_STATE_VERSION, "days": self.days, "periods": self.periods}, state_file)
+        os.replace(tmp_fname, fname)
+
+    def is_current(self, date_stamp: str, vg_mtime: int, vx_mtime: int) -> bool:
+        day = self.days.get(date_stamp)
+        return bool(day) and day["vg_mtime"] == vg_mtime and day["vx_mtime"] == vx_mtime
+
+    def update_day(self, date_stamp: str, totals: dict, vg_mtime: int = None, vx_mtime: int = None):
+        self.remove_day(date_stamp)
+        self.days[date_stamp] = {"vg_mtime": vg_mtime, "vx_mtime": vx_mtime, "totals": totals}
+        self._apply_to_periods(date_stamp, totals, 1)
+
+    def remove_day(self, date_stamp: str):
+        day = self.days.pop(date_stamp, None)
+        if day:
+            self._apply_to_periods(date_stamp, day["totals"], -1)
+
+    def _apply_to_periods(self, date_stamp: str, totals: dict, sign: int):
+        for period, period_key in get_period_keys(date_stamp).items():
+            if period == "day":
+                continue
+            aggregate = self.periods[period].setdefault(period_key, {"days": 0, "totals": {}})
+            aggregate["days"] += sign
+            for key, (vg_cents, vx_cents) in totals.items():
+                acc_totals = aggregate["totals"].setdefault(key, [0, 0])
+                acc_totals[0] += sign * vg_cents
+                acc_totals[1] += sign * vx_cents
+                if acc_totals == [0, 0]:
+                    del aggregate["totals"][key]
+            if aggregate["days"] == 0:
+                del self.periods[period][period_key]
+
+    def get_aggregates(self, period: str) -> dict:
+        """period key -> {"days": n, "totals": {"account:type": [vg, vx]}}, sorted by period key"""
+        if period == "day":
+            return {date_stamp: {"days": 1, "totals": day["totals"]}
+                    for date_stamp, day in sorted(self.days.items())}
+        return dict(sorted(self.periods[period].items()))
+
+
+def reconcile_aggregate(period_key: str, aggregate: dict) -> list[list]:
+    """Match every account of a period by its signed totals, strictly within the tolerance like line_has_match,
+    scaled by the days in the period. Unlike line_has_match the sign counts, so VG -500 and VX +500 don't match"""
+    rows = []
+    tolerance_cents = round(DAY_TOLERANCE * 100) * aggregate["days"]
+    for key, (vg_cents, vx_cents) in sorted(aggregate["totals"].items()):
+        account, _type = key.rsplit(":", 1)
+        matched = abs(vg_cents - vx_cents) < tolerance_cents
+        rows.append([period_key, account, _type, vg_cents / 100, vx_cents / 100, (vg_cents - vx_cents) / 100,
+                     "MATCH" if matched else "NO MATCH"])
+    return rows
+
+
+def refresh_rollup(rollup: PolizaRollup, poliza_vg_dir: str, poliza_vauxoo_dir: str) -> int:
+    """Bring the rollup up to date with both directories. Returns the number of days that changed"""
+    days, _undated = index_poliza_dirs(poliza_vg_dir, poliza_vauxoo_dir)
+    changed = 0
+    for date_stamp in list(rollup.days):
+        day = days.get(date_stamp)
+        if not day or not day.vg_fname or not day.vx_fname:
+            rollup.remove_day(date_stamp)
+            changed += 1
+    for date_stamp, day in days.items():
+        if not day.vg_fname or not day.vx_fname or rollup.is_current(date_stamp, day.vg_mtime, day.vx_mtime):
+            continue
+        totals = get_day_totals(get_vg_poliza_lines(day.vg_fname), get_vx_poliza_lines(day.vx_fname))
+        rollup.update_day(date_stamp, totals, day.vg_mtime, day.vx_mtime)
+        changed += 1
+    return changed
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("POLIZA_VILLAGROUP_DIR", help="Villagroup polizas directory")
+    argparser.add_argument("POLIZA_VX_DIR", help="Vauxoo polizas directory")
+    argparser.add_argument("--period", choices=PERIODS, default="month")
+    argparser.add_argument("--state", default=ROLLUP_STATE_FNAME,
+                           help="File where the materialized totals are kept between runs")
+    argparser.add_argument("--no-refresh", action="store_true",
+                           help="Don't scan the directories, report straight from the state file")
+    argparser.add_argument("--from", dest="date_from", type=parse_date_stamp,
+                           help="Only report periods that end on or after this day")
+    argparser.add_argument("--to", dest="date_to", type=parse_date_stamp,
+                           help="Only report periods that start on or before this day")
+    argparser.add_argument("--only-unmatched", action="store_true")
+    args = argparser.parse_args(argv[1:])
+
+    rollup = PolizaRollup.load(args.state)
+    if not args.no_refresh:
+        changed = refresh_rollup(rollup, args.POLIZA_VILLAGROUP_DIR, args.POLIZA_VX_DIR)
+        if changed:
+            rollup.save(args.state)
+        print(f"{changed} days updated, {len(rollup.days)} days in rollup")
+
+    # Periods overlapping [from, to]
+    first_key = get_period_keys(args.date_from)[args.period] if args.date_from else None
+    last_key = get_period_keys(args.date_to)[args.period] if args.date_to else None
+    rows = []
+    for period_key, aggregate in rollup.get_aggregates(args.period).items():
+        if (first_key and period_key < first_key) or (last_key and period_key > last_key):
+            continue
+        period_rows = reconcile_aggregate(period_key, aggregate)
+        matches = sum(1 for row in period_rows if row[-1] == "MATCH")
+        print("{} ({} days): {}/{} accounts match ({:.2f}%)".format(
+            period_key, aggregate["days"], matches, len(period_rows), matches / (len(period_rows) or 1) * 100))
+        rows.extend(row for row in period_rows if not args.only_unmatched or row[-1] != "MATCH")
+
+    with open(ROLLUP_REPORT_FNAME, "w") as report:
+        writer = csv.writer(report)
+        writer.writerow(ROLLUP_HEADERS)
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
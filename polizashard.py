@@ -0,0 +1,102 @@
+#!/bin/python3
+"""
+Partial DIR_DIFF results of `polizadiff.py --shard i/N`, and the merge of any set of them into the
+same reports and global stats a single process run over every day would produce.
+
+    ./polizadiff.py ../polizas_api ../polizas_vauxoo --collapse-accounts --shard 1/2 --shard-dir /mnt/shared
+    ./polizadiff.py ../polizas_api ../polizas_vauxoo --collapse-accounts --shard 2/2 --shard-dir /mnt/shared
+    ./polizashard.py merge /mnt/shared/POLIZA_SHARD_*.json
+"""
+import sys
+import os
+import json
+import logging
+import argparse
+from polizadiff import (DaySummary, SisterSwap, print_day_summaries_stats, print_sister_swaps,
+                        write_day_summaries_reports, REPORT_FNAME, DIFF_REPORT_FNAME)
+
+log = logging.getLogger(__name__)
+
+SHARD_FNAME = "POLIZA_SHARD_{index}_DE_{count}.json"
+SHARD_FORMAT_VERSION = 1
+
+
+def get_shard_fname(shard_dir: str, shard: tuple) -> str:
+    index, count = shard
+    return os.path.join(shard_dir, SHARD_FNAME.format(index=index, count=count))
+
+
+def write_shard(fname: str, shard: tuple, day_summaries: list[DaySummary]):
+    """Written to a temporary file and renamed, so a merge on another node never reads half a shard"""
+    index, count = shard
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "w") as shard_file:
+        json.dump({"version": SHARD_FORMAT_VERSION, "shard": index, "shards": count,
+                   "days": [day_summary._asdict() for day_summary in day_summaries]}, shard_file)
+    os.replace(tmp_fname, fname)
+
+
+def load_shard(fname: str) -> tuple[tuple, list[DaySummary]]:
+    with open(fname, "r") as shard_file:
+        data = json.load(shard_file)
+    if data.get("version") != SHARD_FORMAT_VERSION:
+        raise ValueError(f"{fname}: unsupported shard format version {data.get('version')}")
+    day_summaries = []
+    for day in data["days"]:
+        day["sister_swaps"] = [SisterSwap(*swap) for swap in day["sister_swaps"]]
+        day_summaries.append(DaySummary(**day))
+    return (data["shard"], data["shards"]), day_summaries
+
+
+def merge_shards(fnames: list[str]) -> list[DaySummary]:
+    """Day summaries of every shard in date order. Shards of different partitions or with
+    overlapping days can't be merged"""
+    shard_count = None
+    seen_shards = set()
+    days = {}
+    for fname in fnames:
+        (index, count), day_summaries = load_shard(fname)
+        if shard_count is None:
+            shard_count = count
+        elif count != shard_count:
+            raise ValueError(f"{fname}: shard {index}/{count} doesn't belong to a {shard_count} shard run")
+        if index in seen_shards:
+            raise ValueError(f"{fname}: shard {index}/{count} was already merged")
+        seen_shards.add(index)
+        for day_summary in day_summaries:
+            if day_summary.date_stamp in days:
+                raise ValueError(f"{fname}: day {day_summary.date_stamp} is in more than one shard")
+            days[day_summary.date_stamp] = day_summary
+    missing = sorted(set(range(1, (shard_count or 0) + 1)) - seen_shards)
+    if missing:
+        log.warning("Shards %s of %d are missing, their days are not in the merged reports",
+                    ", ".join(map(str, missing)), shard_count)
+    return [days[date_stamp] for date_stamp in sorted(days)]
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser()
+    subparsers = argparser.add_subparsers(dest="command", required=True)
+    merge_parser = subparsers.add_parser("merge", help="Merge shard files into the DIR_DIFF reports and global stats")
+    merge_parser.add_argument("SHARD", nargs="+")
+    merge_parser.add_argument("--report", default=REPORT_FNAME)
+    merge_parser.add_argument("--diff-report", default=DIFF_REPORT_FNAME)
+    merge_parser.add_argument("--fast-tables", action="store_true")
+    args = argparser.parse_args(argv[1:])
+
+    try:
+        day_summaries = merge_shards(args.SHARD)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        return 1
+    if not day_summaries:
+        print("ERROR: No days in shards")
+        return 1
+    print_day_summaries_stats(day_summaries)
+    print_sister_swaps(day_summaries, args.fast_tables)
+    write_day_summaries_reports(day_summaries, args.report, args.diff_report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,235 @@
+#!/bin/python3
+"""
+Local SQLite store for normalized VG/VX poliza lines and their per day reconciliation results,
+indexed by date, account and concept so questions over a date range are a query instead of a
+DIR_DIFF re-run.
+
+    ./polizastore.py ingest ../polizas_api ../polizas_vauxoo --collapse-accounts
+    ./polizastore.py account 41030101300 --from 2023-01-01 --to 2023-03-31
+    ./polizastore.py top-unmatched --limit 20
+    ./polizastore.py day 2023-01-15
+"""
+import sys
+import os
+import argparse
+import sqlite3
+from polizadiff import (index_poliza_dirs, get_vg_poliza_lines, get_vx_poliza_lines, tag_no_account_lines,
+                        diff_poliza_day, make_day_filter, parse_date_stamp, get_table_renderer, amount_cents,
+                        ReconcileOptions, COLLAPSE_FNAME)
+from poliza_payload import file_sha256
+
+POLIZA_DB_FNAME = "polizas.db"
+
+DAY_TABLES = ("lines", "matches", "account_results", "days")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    date TEXT PRIMARY KEY,
+    vg_fname TEXT,
+    vx_fname TEXT,
+    vg_mtime INTEGER,
+    vx_mtime INTEGER,
+    options TEXT,
+    match_pctg REAL
+);
+CREATE TABLE IF NOT EXISTS lines (
+    date TEXT NOT NULL,
+    side TEXT NOT NULL,
+    account TEXT NOT NULL,
+    concept TEXT NOT NULL,
+    cents INTEGER NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_date ON lines (date);
+CREATE INDEX IF NOT EXISTS lines_account_date ON lines (account, date);
+CREATE INDEX IF NOT EXISTS lines_concept ON lines (concept);
+CREATE TABLE IF NOT EXISTS matches (
+    date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    vg_account TEXT,
+    vg_concept TEXT,
+    vg_cents INTEGER,
+    vx_account TEXT,
+    vx_concept TEXT,
+    vx_cents INTEGER
+);
+CREATE INDEX IF NOT EXISTS matches_date ON matches (date);
+CREATE INDEX IF NOT EXISTS matches_account_date ON matches (vg_account, date);
+CREATE INDEX IF NOT EXISTS matches_status_concept ON matches (status, vg_concept);
+CREATE TABLE IF NOT EXISTS account_results (
+    date TEXT NOT NULL,
+    account TEXT NOT NULL,
+    diff REAL,
+    unmatched INTEGER NOT NULL,
+    PRIMARY KEY (account, date)
+);
+CREATE INDEX IF NOT EXISTS account_results_date ON account_results (date);
+"""
+
+
+def connect(db_fname: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_fname)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _line_cents(line):
+    return amount_cents(line) if line and line.amount else None
+
+
+def get_options_key(options: ReconcileOptions) -> str:
+    """The options plus the contents of the collapse file they use, so editing .collapse re-ingests every day"""
+    collapse_sha256 = None
+    if options.collapse_accounts and os.path.exists(options.collapse_file):
+        collapse_sha256 = file_sha256(options.collapse_file)
+    return repr((tuple(options), collapse_sha256))
+
+
+def delete_day(conn: sqlite3.Connection, date: str, tables=DAY_TABLES):
+    for table in tables:
+        conn.execute(f"DELETE FROM {table} WHERE date = ?", (date,))
+
+
+def ingest_day(conn: sqlite3.Connection, day, options: ReconcileOptions, options_key: str):
+    lines_vg = tag_no_account_lines(get_vg_poliza_lines(day.vg_fname))
+    lines_vx = tag_no_account_lines(get_vx_poliza_lines(day.vx_fname))
+    day_result = diff_poliza_day(day.date_stamp, lines_vg, lines_vx, options)
+    date = day.date_stamp
+    delete_day(conn, date, ("lines", "matches", "account_results"))
+    conn.executemany(
+        "INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?)",
+        [(date, side, line.account, line.concept, amount_cents(line), line.type)
+         for side, lines in (("VG", lines_vg), ("VX", lines_vx)) for line in lines])
+    match_rows = []
+    for status, pairs in (("MATCH", day_result.matched_lines), ("NO MATCH", day_result.unmatched_lines)):
+        for vg, vx in pairs:
+            match_rows.append((date, status, vg.account, vg.concept, _line_cents(vg),
+                               vx.account if vx else None, vx.concept if vx else None, _line_cents(vx)))
+    conn.executemany("INSERT INTO matches VALUES (?, ?, ?, ?, ?, ?, ?, ?)", match_rows)
+    conn.executemany(
+        "INSERT INTO account_results VALUES (?, ?, ?, ?)",
+        [(date, account, day_result.diffs_by_acc.get(account), unmatched)
+         for account, unmatched in day_result.matches_by_acc.items()])
+    conn.execute("INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?, ?, ?)",
+                 (date, day.vg_fname, day.vx_fname, day.vg_mtime, day.vx_mtime, options_key,
+                  day_result.match_pctg))
+
+
+def ingest(conn: sqlite3.Connection, poliza_vg_dir: str, poliza_vauxoo_dir: str, options: ReconcileOptions,
+           day_filter=None, force=False) -> tuple[int, int]:
+    """Load every day with both polizas, skipping the ones already ingested with the same files and options,
+    and delete the days within day_filter that no longer have both. Returns the number of days ingested and deleted"""
+    days, _undated = index_poliza_dirs(poliza_vg_dir, poliza_vauxoo_dir, day_filter)
+    ingested = {row[0]: row[1:] for row in conn.execute(
+        "SELECT date, vg_fname, vx_fname, vg_mtime, vx_mtime, options FROM days")}
+    options_key = get_options_key(options)
+    deleted = 0
+    for date_stamp in ingested:
+        day = days.get(date_stamp)
+        if (day_filter and not day_filter(date_stamp)) or (day and day.vg_fname and day.vx_fname):
+            continue
+        with conn:
+            delete_day(conn, date_stamp)
+        deleted += 1
+    count = 0
+    for date_stamp, day in days.items():
+        if not day.vg_fname or not day.vx_fname:
+            continue
+        current = (day.vg_fname, day.vx_fname, day.vg_mtime, day.vx_mtime, options_key)
+        if not force and ingested.get(date_stamp) == current:
+            continue
+        with conn:
+            ingest_day(conn, day, options, options_key)
+        count += 1
+    return count, deleted
+
+
+def _date_range_clause(args, column="date") -> tuple[str, list]:
+    clauses, params = [], []
+    if args.date_from:
+        clauses.append(f"{column} >= ?")
+        params.append(args.date_from)
+    if args.date_to:
+        clauses.append(f"{column} <= ?")
+        params.append(args.date_to)
+    return "".join(f" AND {clause}" for clause in clauses), params
+
+
+def account_series(conn: sqlite3.Connection, account: str, args) -> list[tuple]:
+    """Per day VG and VX totals, diff and match status of an account"""
+    date_clause, params = _date_range_clause(args, "l.date")
+    return conn.execute(f"""
+        SELECT l.date,
+               SUM(CASE WHEN l.side = 'VG' THEN l.cents ELSE 0 END) / 100.0,
+               SUM(CASE WHEN l.side = 'VX' THEN l.cents ELSE 0 END) / 100.0,
+               ar.diff,
+               CASE ar.unmatched WHEN 1 THEN 'NO MATCH' WHEN 0 THEN 'MATCH' ELSE '' END
+        FROM lines l LEFT JOIN account_results ar ON ar.account = l.account AND ar.date = l.date
+        WHERE l.account = ?{date_clause}
+        GROUP BY l.date ORDER BY l.date""", [account] + params).fetchall()
+
+
+def top_unmatched(conn: sqlite3.Connection, args) -> list[tuple]:
+    date_clause, params = _date_range_clause(args)
+    return conn.execute(f"""
+        SELECT vg_account, vg_concept, COUNT(*) AS misses, MIN(date), MAX(date)
+        FROM matches WHERE status = 'NO MATCH'{date_clause}
+        GROUP BY vg_account, vg_concept ORDER BY misses DESC, vg_account LIMIT ?""", params + [args.limit]).fetchall()
+
+
+def day_detail(conn: sqlite3.Connection, date_stamp: str, only_unmatched=False) -> list[tuple]:
+    status_clause = " AND status = 'NO MATCH'" if only_unmatched else ""
+    return conn.execute(f"""
+        SELECT status, vg_account, vg_concept, vg_cents / 100.0, vx_cents / 100.0, vx_concept, vx_account
+        FROM matches WHERE date = ?{status_clause} ORDER BY status DESC, vg_account""", (date_stamp,)).fetchall()
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--db", default=POLIZA_DB_FNAME)
+    subparsers = argparser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Load both poliza directories and their match results")
+    ingest_parser.add_argument("POLIZA_VILLAGROUP_DIR")
+    ingest_parser.add_argument("POLIZA_VX_DIR")
+    ingest_parser.add_argument("--collapse-accounts", action="store_true")
+    ingest_parser.add_argument("--collapse-file", default=COLLAPSE_FNAME)
+    ingest_parser.add_argument("--force", action="store_true", help="Re-ingest days that didn't change")
+
+    account_parser = subparsers.add_parser("account", help="Per day time series of an account")
+    account_parser.add_argument("ACCOUNT")
+
+    top_parser = subparsers.add_parser("top-unmatched", help="Concepts that failed to match most often")
+    top_parser.add_argument("--limit", type=int, default=20)
+
+    day_parser = subparsers.add_parser("day", help="Match results of a single day")
+    day_parser.add_argument("DATE", type=parse_date_stamp)
+    day_parser.add_argument("--only-unmatched", action="store_true")
+
+    for parser in (ingest_parser, account_parser, top_parser):
+        parser.add_argument("--from", dest="date_from", type=parse_date_stamp)
+        parser.add_argument("--to", dest="date_to", type=parse_date_stamp)
+    args = argparser.parse_args(argv[1:])
+
+    conn = connect(args.db)
+    render_table = get_table_renderer()
+    if args.command == "ingest":
+        options = ReconcileOptions(collapse_accounts=args.collapse_accounts, collapse_file=args.collapse_file)
+        count, deleted = ingest(conn, args.POLIZA_VILLAGROUP_DIR, args.POLIZA_VX_DIR, options,
+                                make_day_filter(args.date_from, args.date_to), args.force)
+        print(f"{count} days ingested into {args.db}, {deleted} days no longer in the directories deleted")
+    elif args.command == "account":
+        print(render_table(account_series(conn, args.ACCOUNT, args),
+                           headers=["Fecha", "VG", "VX", "Diff", "STATUS"]))
+    elif args.command == "top-unmatched":
+        print(render_table(top_unmatched(conn, args),
+                           headers=["VG account", "VG concept", "Misses", "First", "Last"]))
+    elif args.command == "day":
+        print(render_table(day_detail(conn, args.DATE, args.only_unmatched),
+                           headers=["STATUS", "VG account", "VG concept", "VG amount", "VX amount", "VX concept",
+                                    "VX account"]))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,61 @@
+from poliza2csv import SKIP_FIRST, iter_txt_poliza_lines, process_line
+
+
+def old_txt_poliza_lines(fname, line_filter=None):
+    """The text mode parser iter_txt_poliza_lines replaced"""
+    with open(fname, "r", encoding="ISO-8859-1", newline="") as txt_file:
+        lines = txt_file.read().splitlines(keepends=True)[SKIP_FIRST:]
+    parsed = filter(None, map(process_line, lines))
+    return [line for line in parsed if line_filter is None or line_filter(line.concept)]
+
+
+def record(account, concept, amount):
+    return f"{account:<11}{concept:<50}{amount:>20}"
+
+
+def write_txt(tmp_path, records, newline="\n", trailing=True):
+    fname = tmp_path / "poliza.txt"
+    content = newline.join(["POLIZA DE DIARIO", "CUENTA     CONCEPTO"] + records) + (newline if trailing else "")
+    fname.write_bytes(content.encode("ISO-8859-1"))
+    return str(fname)
+
+
+RECORDS = [
+    record("41140100100", "PALMITA MARKET", "-1234.56a"),
+    record("41040200200", "DELI BEBIDAS", "99.00c"),
+    record("41030101300", "Tratamientos-Todo el día-SPA", "-0.50a"),
+    # Amount not right aligned, with text around it
+    "41040100100" + "DELI ALIMENTOS".ljust(50) + "  MXN 15.25a  ref 7",
+    # No amount at all
+    record("41040100101", "SIN MONTO", ""),
+    # Doubled sign
+    record("41040100102", "DOBLE SIGNO", "--3.00c"),
+    # Exactly one byte short of a full concept, the newline completes it
+    "41040100103" + "X" * 49,
+    # Too short to be a record
+    "41040100104" + "CORTA",
+    "",
+]
+
+
+def test_iter_txt_poliza_lines_matches_process_line(tmp_path):
+    fname = write_txt(tmp_path, RECORDS)
+    assert list(iter_txt_poliza_lines(fname)) == old_txt_poliza_lines(fname)
+    assert len(old_txt_poliza_lines(fname)) == 7
+
+
+def test_iter_txt_poliza_lines_crlf_and_no_trailing_newline(tmp_path):
+    fname = write_txt(tmp_path, RECORDS[:4], newline="\r\n", trailing=False)
+    assert list(iter_txt_poliza_lines(fname)) == old_txt_poliza_lines(fname)
+
+
+def test_iter_txt_poliza_lines_filter_and_empty_files(tmp_path):
+    fname = write_txt(tmp_path, RECORDS)
+    line_filter = lambda concept: "DELI" in concept
+    assert list(iter_txt_poliza_lines(fname, line_filter)) == old_txt_poliza_lines(fname, line_filter)
+    empty = tmp_path / "empty.txt"
+    empty.write_bytes(b"")
+    assert list(iter_txt_poliza_lines(str(empty))) == []
+    header_only = tmp_path / "header.txt"
+    header_only.write_bytes(b"POLIZA DE DIARIO\n")
+    assert list(iter_txt_poliza_lines(str(header_only))) == []
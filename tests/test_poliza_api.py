@@ -0,0 +1,105 @@
+import os
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+
+import requests
+
+import poliza_api
+from poliza_api import get_backfill_requests, get_downloaded_dates, get_missing_date_ranges
+from poliza_http import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, PolizaHTTPClient
+from poliza_metrics import PipelineMetrics
+from poliza_payload import write_payload
+
+
+def d(day):
+    return datetime(2023, 1, day)
+
+
+def test_missing_date_ranges_merge_consecutive_days():
+    downloaded = {d(3), d(4), d(7)}
+    assert get_missing_date_ranges(d(1), d(9), downloaded) == [(d(1), d(2)), (d(5), d(6)), (d(8), d(9))]
+
+
+def test_missing_date_ranges_edges():
+    assert get_missing_date_ranges(d(1), d(3), {d(1), d(2), d(3)}) == []
+    assert get_missing_date_ranges(d(1), d(3), set()) == [(d(1), d(3))]
+    assert get_missing_date_ranges(d(2), d(2), {d(1), d(3)}) == [(d(2), d(2))]
+    assert get_missing_date_ranges(d(1), d(5), {d(2), d(4)}) == [(d(1), d(1)), (d(3), d(3)), (d(5), d(5))]
+    assert get_missing_date_ranges(d(3), d(1), set()) == []
+
+
+def test_backfill_requests_end_the_day_after_each_range():
+    requests = get_backfill_requests([(d(1), d(2)), (d(5), d(5))])
+    assert [(request.start_date, request.end_date) for request in requests] == [(d(1), d(3)), (d(5), d(6))]
+
+
+def test_downloaded_dates_quarantine_invalid_payloads(tmp_path):
+    write_payload(str(tmp_path / "POLIZAINGRESOS_20230101.json.gz"), {"Poliza": []})
+    write_payload(str(tmp_path / "POLIZAINGRESOS_20230102.json.gz"), {"Poliza": []})
+    (tmp_path / "POLIZAINGRESOS_20230102.json.gz").write_bytes(b"tampered")
+    (tmp_path / "POLIZAINGRESOS_20230103.json").write_text('{"Poliza": [')
+    (tmp_path / "notes.txt").write_text("")
+    assert get_downloaded_dates(str(tmp_path)) == {d(1), d(2), d(3)}
+    assert get_downloaded_dates(str(tmp_path), verify=True) == {d(1)}
+    assert sorted(os.listdir(tmp_path)) == [
+        ".POLIZAINGRESOS_20230102.json.gz.invalid", ".POLIZAINGRESOS_20230102.json.gz.invalid.sha256",
+        ".POLIZAINGRESOS_20230103.json.invalid", "POLIZAINGRESOS_20230101.json.gz",
+        "POLIZAINGRESOS_20230101.json.gz.sha256", "notes.txt"]
+    assert get_downloaded_dates(str(tmp_path / "missing")) == set()
+
+
+def run_get_payloads(iterations):
+    async def run():
+        task = asyncio.create_task(poliza_api.get_payloads(asyncio.Lock(), asyncio.Lock(), interval=0))
+        for _ in range(iterations):
+            await asyncio.sleep(0)
+        poliza_api.global_exit_flag.append(True)
+        await task
+        poliza_api.global_exit_flag.clear()
+    asyncio.run(run())
+
+
+def test_open_circuit_doesnt_use_up_download_attempts(monkeypatch):
+    client = PolizaHTTPClient("http://vg.invalid/")
+
+    def fail(method, url, **kwargs):
+        raise requests.ConnectionError("VG is down")
+    monkeypatch.setattr(client.session, "request", fail)
+    monkeypatch.setattr(poliza_api, "_http_client", client)
+    monkeypatch.setattr(poliza_api, "pending_downloads", {d(1), d(2), d(3)})
+    monkeypatch.setattr(poliza_api, "download_attempts", defaultdict(int))
+    monkeypatch.setattr(poliza_api, "failed_downloads", [])
+    monkeypatch.setattr(poliza_api, "global_exit_flag", [])
+    monkeypatch.setattr(poliza_api, "metrics", PipelineMetrics())
+
+    run_get_payloads(100)
+    stats = client.stats["Poliza"]
+    assert stats["requests"] == CIRCUIT_FAILURE_THRESHOLD
+    assert stats["rejected"] > 3 * poliza_api.MAX_DOWNLOAD_ATTEMPTS
+    assert poliza_api.failed_downloads == []
+    assert poliza_api.pending_downloads == {d(1), d(2), d(3)}
+    assert sum(poliza_api.download_attempts.values()) == CIRCUIT_FAILURE_THRESHOLD
+
+    # Once the circuit half-opens a single download goes through, and its failure opens it again
+    client.breakers["Poliza"].opened_at -= CIRCUIT_RESET_TIMEOUT
+    run_get_payloads(20)
+    assert stats["requests"] == CIRCUIT_FAILURE_THRESHOLD + 1
+    assert poliza_api.pending_downloads == {d(1), d(2), d(3)}
+
+
+def test_reconciler_skips_days_that_fail(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "POLIZAINGRESOS_VX20230101.csv").write_text("account,concept,amount\n411401001,PALMITA MARKET,-100.00a\n")
+    (tmp_path / "POLIZAINGRESOS_VX20230102.csv").write_text("account,concept,amount\n411401001,PALMITA MARKET\n")
+    payload = {"Poliza": [{"Cuenta": "41140100100", "Concepto": "PALMITA MARKET", "Cargo": "100.00", "Abono": "0"}]}
+    reconciler = poliza_api.PayloadReconciler(str(tmp_path), report_fname="matches.csv", diff_report_fname="diffs.csv")
+    for day in (d(1), d(2), d(3)):
+        reconciler.submit(day, payload, f"POLIZAINGRESOS_{day:%Y%m%d}.json.gz")
+    reconciler.finish()
+    out = capsys.readouterr().out
+    assert "SKIP: 20230102: AssertionError" in out
+    assert "POLIZAINGRESOS_VX20230103.csv not found" in out
+    with open("diffs.csv") as diffs:
+        assert [row.split(",")[0] for row in diffs.read().splitlines()] == ["Fecha", "01-01-2023"]
+    assert not os.path.exists("REPORTE_DIFFS_POLIZA.csv")
@@ -0,0 +1,63 @@
+import gzip
+import json
+
+import pytest
+
+from poliza_payload import (CHECKSUM_SUFFIX, file_sha256, iter_payload_entries, load_payload, verify_payload,
+                           write_payload)
+
+PAYLOAD = {
+    "Poliza": [
+        {"Cuenta": "41140100100", "Concepto": "PALMITA MARKET", "Cargo": "0.00", "Abono": "1234.56"},
+        {"Cuenta": "41040200200", "Concepto": "Tratamientos-Todo el día-SPA", "Cargo": "99.5", "Abono": "0"},
+    ],
+    "Mensaje": "OK",
+}
+
+
+def test_write_payload_round_trip(tmp_path):
+    fname = str(tmp_path / "POLIZAINGRESOS_20230101.json.gz")
+    checksum = write_payload(fname, PAYLOAD)
+    assert checksum == file_sha256(fname)
+    with open(fname + CHECKSUM_SUFFIX) as checksum_file:
+        assert checksum_file.read() == f"{checksum}  POLIZAINGRESOS_20230101.json.gz\n"
+    assert verify_payload(fname)
+    assert load_payload(fname) == PAYLOAD
+    assert list(iter_payload_entries(fname)) == PAYLOAD["Poliza"]
+    assert [path.name for path in tmp_path.iterdir() if path.name.startswith(".")] == []
+
+
+def test_write_payload_is_deterministic(tmp_path):
+    assert write_payload(str(tmp_path / "a.json.gz"), PAYLOAD) == write_payload(str(tmp_path / "b.json.gz"), PAYLOAD)
+
+
+def test_verify_payload_detects_tampering(tmp_path):
+    fname = str(tmp_path / "POLIZAINGRESOS_20230101.json.gz")
+    write_payload(fname, PAYLOAD)
+    with gzip.open(fname, "wb") as gz_file:
+        gz_file.write(json.dumps(dict(PAYLOAD, Mensaje="KO")).encode())
+    assert not verify_payload(fname)
+
+
+def test_verify_payload_without_sidecar(tmp_path):
+    complete = tmp_path / "POLIZAINGRESOS_20230101.json"
+    complete.write_text(json.dumps(PAYLOAD), encoding="ISO-8859-1")
+    assert verify_payload(str(complete))
+    assert list(iter_payload_entries(str(complete))) == PAYLOAD["Poliza"]
+    truncated = tmp_path / "POLIZAINGRESOS_20230102.json"
+    truncated.write_text(json.dumps(PAYLOAD)[:-20], encoding="ISO-8859-1")
+    assert not verify_payload(str(truncated))
+    truncated_gz = tmp_path / "POLIZAINGRESOS_20230103.json.gz"
+    truncated_gz.write_bytes(gzip.compress(json.dumps(PAYLOAD).encode())[:-10])
+    assert not verify_payload(str(truncated_gz))
+
+
+def test_iter_payload_entries_rejects_truncated_streams(tmp_path):
+    fname = str(tmp_path / "POLIZAINGRESOS_20230101.json.gz")
+    write_payload(fname, PAYLOAD)
+    with gzip.open(fname, "rt", encoding="utf-8") as gz_file:
+        lines = gz_file.readlines()
+    with gzip.open(fname, "wt", encoding="utf-8") as gz_file:
+        gz_file.writelines(lines[:2])
+    with pytest.raises(ValueError, match="is truncated"):
+        list(iter_payload_entries(fname))
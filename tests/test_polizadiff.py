@@ -0,0 +1,137 @@
+import sys
+
+import pytest
+from poliza2csv import PolizaLine
+from polizadiff import (ReconcileOptions, reconcile, main, print_day_summaries_stats, ShiftWindow, diff_poliza_day, summarize_day, apply_shifted_match,
+                        render_fixed_width_table, AmountIndex)
+
+OPTIONS = ReconcileOptions()
+
+
+def line(account, concept, amount, _type="a"):
+    sign = "-" if amount.startswith("-") else "+"
+    return PolizaLine(account, concept, sign, amount.lstrip("-"), _type)
+
+
+def test_shift_window_pairs_lines_across_days():
+    window = ShiftWindow(1)
+    market = line("41140100100", "PALMITA MARKET", "-100.00")
+    day1 = diff_poliza_day("20230101", [market], [], OPTIONS)
+    day2 = diff_poliza_day("20230102", [], [market], OPTIONS)
+    assert window.add_day(day1, [], OPTIONS) == []
+    [shifted] = window.add_day(day2, [market], OPTIONS)
+    assert (shifted.vg_date_stamp, shifted.vx_date_stamp, shifted.offset) == ("20230101", "20230102", 1)
+    assert not window.vg_index and not window.vx_index
+
+
+def test_shift_window_evicts_days_outside_window():
+    window = ShiftWindow(1)
+    market = line("41140100100", "PALMITA MARKET", "-100.00")
+    window.add_day(diff_poliza_day("20230101", [market], [], OPTIONS), [], OPTIONS)
+    assert window.add_day(diff_poliza_day("20230103", [], [market], OPTIONS), [market], OPTIONS) == []
+    assert not window.vg_index
+    assert list(window.vx_index) == [("41140100100", "a", -10000)]
+
+
+def test_apply_shifted_match_removes_unmatched_concept():
+    window = ShiftWindow(1)
+    market = line("41140100100", "PALMITA MARKET", "-100.00")
+    day1 = diff_poliza_day("20230101", [market], [], OPTIONS)
+    summary = summarize_day(day1)
+    window.add_day(day1, [], OPTIONS)
+    [shifted] = window.add_day(diff_poliza_day("20230102", [], [market], OPTIONS), [market], OPTIONS)
+    summary = apply_shifted_match(summary, shifted)
+    assert (summary.matches, summary.non_matches, summary.unmatched_concepts) == (1, 0, {})
+
+
+def test_sister_swaps_need_a_sister_file(tmp_path):
+    lines_vg = [line("41040100100", "DELI ALIMENTOS", "-150.00"), line("41040200200", "DELI BEBIDAS", "-50.00")]
+    lines_vx = [line("41040100100", "DELI ALIMENTOS", "-100.00"), line("41040200200", "DELI BEBIDAS", "-100.00")]
+    assert diff_poliza_day("20230101", lines_vg, lines_vx, OPTIONS).sister_swaps == []
+    sister_file = tmp_path / "sisters.csv"
+    sister_file.write_text("41040100100,DELI\n41040200200,DELI\n")
+    options = ReconcileOptions(sister_file=str(sister_file))
+    [swap] = diff_poliza_day("20230101", lines_vg, lines_vx, options).sister_swaps
+    assert (swap.account_a, swap.account_b, swap.moved_cents, swap.residual_cents) == (
+        "41040100100", "41040200200", 5000, 0)
+
+
+def test_fixed_width_table_renders_like_tabulate():
+    tabulate = pytest.importorskip("tabulate")
+    headers = ["Tipo", "Cuenta A", "Dias", "Total movido", "Activo", "Monto"]
+    rows = [["a", "41040100100", 1, "12.50", "True", "-1234.56a"],
+            ["c", "SIN CUENTA", 12, "-777.00", "False", "0.10c"],
+            ["a", "41140100100", "", "1", "", "-5.00a"]]
+    assert render_fixed_width_table(rows, headers) == tabulate.tabulate(rows, headers=headers)
+
+
+def test_amount_index_within_is_strict_and_by_type():
+    lines = [line("1", "A", "-10.00"), line("2", "B", "-12.00"), line("3", "C", "-15.00"), line("4", "D", "-12.00", "c")]
+    index = AmountIndex(lines)
+    assert [found.account for found in index.within("a", -1000, 500)] == ["2", "1"]
+    assert [found.account for found in index.within("a", -1200, 200)] == ["2"]
+    assert index.within("c", -1500, 100) == []
+    assert index.within("x", 0, 100) == []
+
+
+def test_near_misses_skip_the_same_account():
+    vg = line("41140100100", "PALMITA MARKET", "-100.00")
+    vx_lines = [line("41140100100", "PALMITA MARKET", "-101.00"), line("41040200200", "DELI BEBIDAS", "-103.00"),
+                line("41040100100", "DELI ALIMENTOS", "100.50"), line("41030101300", "SPA", "-110.00")]
+    index = AmountIndex(vx_lines)
+    close = index.get_near_misses(vg, margin=5.0, close=True)
+    assert [(near_miss.kind, near_miss.source.account, near_miss.diff) for near_miss in close] == [
+        ("CLOSE", "41040200200", -3.0)]
+    inverted = index.get_near_misses(vg, margin=1.0, close=False, inverted_sign=True)
+    assert [(near_miss.kind, near_miss.source.account, near_miss.diff) for near_miss in inverted] == [
+        ("INVERTED SIGN", "41040100100", 0.5)]
+
+
+def test_close_matches_in_diff_poliza_day():
+    lines_vg = [line("41140100100", "PALMITA MARKET", "-100.00")]
+    lines_vx = [line("41140100100", "PALMITA MARKET", "-90.00"), line("41040200200", "DELI BEBIDAS", "-99.00")]
+    options = ReconcileOptions(show_close_matches=True)
+    day_result = diff_poliza_day("20230101", lines_vg, lines_vx, options)
+    assert [(near_miss.target.account, near_miss.source.account) for near_miss in day_result.near_misses] == [
+        ("41140100100", "41040200200")]
+    assert diff_poliza_day("20230101", lines_vg, lines_vx, OPTIONS).near_misses == []
+
+
+def test_account_diffs_and_sister_swaps_are_vx_minus_vg(tmp_path):
+    sister_file = tmp_path / "sisters.csv"
+    sister_file.write_text("41040100100,DELI\n41040200200,DELI\n")
+    lines_vg = [line("41140100100", "PALMITA MARKET", "101.00"), line("41040100100", "DELI ALIMENTOS", "60.00"),
+                line("41040200200", "DELI BEBIDAS", "40.00")]
+    lines_vx = [line("41140100100", "PALMITA MARKET", "100.00"), line("41040100100", "DELI ALIMENTOS", "50.00"),
+                line("41040200200", "DELI BEBIDAS", "50.00")]
+    result = reconcile(lines_vg, lines_vx, ReconcileOptions(sister_file=str(sister_file)), "20230101")
+    # VG 101.00 against VX 100.00
+    assert result.account_diffs["41140100100"] == pytest.approx(-1.0)
+    assert result.to_dict()["account_diffs"]["41140100100"] == pytest.approx(-1.0)
+    [swap] = result.sister_swaps
+    # VG 60.00 against VX 50.00
+    assert (swap.account_a, swap.moved_cents) == ("41040100100", -1000)
+
+
+def test_dir_diff_with_no_days_selected(tmp_path, monkeypatch, capsys):
+    vg_dir, vx_dir = tmp_path / "vg", tmp_path / "vx"
+    vg_dir.mkdir()
+    vx_dir.mkdir()
+    (vg_dir / "POLIZAINGRESOS_20230101.json").write_text(
+        '{"Poliza": [{"Cuenta": "41140100100", "Concepto": "PALMITA MARKET", "Cargo": 0.0, "Abono": 100.0}]}')
+    (vx_dir / "POLIZAINGRESOS_VX20230101.csv").write_text("account,concept,amount\n411401001,PALMITA MARKET,-100.00a\n")
+    monkeypatch.chdir(tmp_path)
+    for day_filter in (["--from", "2023-02-01"], ["--weekday", "mon"]):
+        argv = ["polizadiff.py", str(vg_dir), str(vx_dir)] + day_filter
+        monkeypatch.setattr(sys, "argv", argv)
+        main(argv)
+        assert "No days selected" in capsys.readouterr().out
+    assert not (tmp_path / "REPORTE_MATCHES_POLIZA.csv").exists()
+    print_day_summaries_stats([])
+    assert capsys.readouterr().out == "No days selected\n"
+
+
+def test_near_misses_skip_the_padded_same_account():
+    vg = line("411401001", "PALMITA MARKET", "-100.00")
+    index = AmountIndex([line("41140100100", "PALMITA MARKET", "-101.00"), line("41040200200", "DELI BEBIDAS", "-102.00")])
+    assert [near_miss.source.account for near_miss in index.get_near_misses(vg, margin=5.0)] == ["41040200200"]
@@ -0,0 +1,39 @@
+from poliza2csv import PolizaLine
+from polizarollup import PolizaRollup, get_day_totals, reconcile_aggregate
+
+
+def test_opposite_signs_dont_match():
+    aggregate = {"days": 1, "totals": {"41140100100:a": [-50000, 50000]}}
+    [row] = reconcile_aggregate("2023-01", aggregate)
+    assert row[3:] == [-500.0, 500.0, -1000.0, "NO MATCH"]
+
+
+def test_tolerance_scales_with_days():
+    aggregate = {"days": 3, "totals": {"41140100100:a": [-50000, -49401], "41040200200:a": [-50000, -49400]}}
+    status = {row[1]: row[-1] for row in reconcile_aggregate("2023-01", aggregate)}
+    assert status == {"41140100100": "MATCH", "41040200200": "NO MATCH"}
+
+
+def test_update_day_replaces_old_totals_in_periods():
+    rollup = PolizaRollup()
+    lines_vg = [PolizaLine("41140100100", "PALMITA MARKET", "-", "100.00", "a")]
+    lines_vx = [PolizaLine("41140100100", "PALMITA MARKET", "-", "90.00", "a")]
+    rollup.update_day("20230101", get_day_totals(lines_vg, lines_vx))
+    rollup.update_day("20230102", get_day_totals(lines_vg, lines_vg))
+    rollup.update_day("20230101", get_day_totals(lines_vg, lines_vg))
+    month = rollup.get_aggregates("month")["2023-01"]
+    assert month == {"days": 2, "totals": {"41140100100:a": [-20000, -20000]}}
+
+
+def test_padded_and_unpadded_accounts_aggregate_together():
+    lines_vg = [PolizaLine("4101010", "HABITACIONES", "-", "100.00", "a"), PolizaLine("", "SIN CUENTA", "-", "1.00", "a")]
+    lines_vx = [PolizaLine("41010100000", "HABITACIONES", "-", "100.50", "a")]
+    totals = get_day_totals(lines_vg, lines_vx)
+    assert totals == {"41010100000:a": [-10000, -10050], "SIN CUENTA:a": [-100, 0]}
+    [row, _no_account] = reconcile_aggregate("20230101", {"days": 1, "totals": totals})
+    assert row[1:] == ["41010100000", "a", -100.0, -100.5, 0.5, "MATCH"]
+
+
+def test_outdated_state_is_rebuilt():
+    rollup = PolizaRollup({"days": {"20230101": {"totals": {"4101010:a": [1, 0]}}}, "periods": {}})
+    assert rollup.days == {} and "month" in rollup.periods
@@ -0,0 +1,43 @@
+import pytest
+
+from polizadiff import DaySummary, SisterSwap
+from polizashard import merge_shards, write_shard
+
+
+def day(date_stamp, matches=1):
+    return DaySummary(date_stamp, 2, matches, 1, {"DELI BEBIDAS": 1}, {"41040200200": matches},
+                      {"41040200200": -1.5}, [SisterSwap("a", "41040100100", "41040200200", 350, 0)])
+
+
+def shard(tmp_path, index, count, date_stamps):
+    fname = str(tmp_path / f"shard_{index}_{count}_{'_'.join(date_stamps)}.json")
+    write_shard(fname, (index, count), [day(date_stamp) for date_stamp in date_stamps])
+    return fname
+
+
+def test_merge_shards_in_date_order(tmp_path):
+    fnames = [shard(tmp_path, 2, 2, ["20230102", "20230104"]), shard(tmp_path, 1, 2, ["20230101", "20230103"])]
+    merged = merge_shards(fnames)
+    assert [day_summary.date_stamp for day_summary in merged] == ["20230101", "20230102", "20230103", "20230104"]
+    assert merged[0] == day("20230101")
+
+
+def test_merge_shards_warns_about_missing_shards(tmp_path, caplog):
+    merged = merge_shards([shard(tmp_path, 1, 3, ["20230101"])])
+    assert [day_summary.date_stamp for day_summary in merged] == ["20230101"]
+    assert "Shards 2, 3 of 3 are missing" in caplog.text
+
+
+def test_merge_shards_rejects_mixed_shard_counts(tmp_path):
+    with pytest.raises(ValueError, match="doesn't belong to a 2 shard run"):
+        merge_shards([shard(tmp_path, 1, 2, ["20230101"]), shard(tmp_path, 2, 3, ["20230102"])])
+
+
+def test_merge_shards_rejects_duplicate_shards(tmp_path):
+    with pytest.raises(ValueError, match="was already merged"):
+        merge_shards([shard(tmp_path, 1, 2, ["20230101"]), shard(tmp_path, 1, 2, ["20230102"])])
+
+
+def test_merge_shards_rejects_duplicate_days(tmp_path):
+    with pytest.raises(ValueError, match="day 20230102 is in more than one shard"):
+        merge_shards([shard(tmp_path, 1, 2, ["20230101", "20230102"]), shard(tmp_path, 2, 2, ["20230102"])])